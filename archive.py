@@ -0,0 +1,104 @@
+import asyncio
+import json
+import logging
+import zlib
+from collections import defaultdict
+
+from history_search import unindex_rows
+
+
+def _archive_batch(conn, retention_days, limit):
+    # ids grow with time, so the oldest rows come first and the scan stops early
+    rows = conn.execute("""
+        SELECT id, user_id, category, user_message, bot_response, timestamp FROM interactions
+        WHERE timestamp IS NULL OR timestamp < datetime('now', ?)
+        ORDER BY id
+        LIMIT ?
+    """, (f"-{retention_days} days", limit)).fetchall()
+    if not rows:
+        return 0
+
+    groups = defaultdict(list)
+    for row in rows:
+        groups[(row[1], row[2])].append([row[0], row[3], row[4], row[5]])
+
+    conn.execute("BEGIN")
+    try:
+        for (user_id, category), items in groups.items():
+            payload = zlib.compress(json.dumps(items, ensure_ascii=False).encode(), 9)
+            conn.execute("""
+                INSERT INTO interactions_archive (user_id, category, first_id, last_id, row_count, payload)
+                VALUES (?, ?, ?, ?, ?, ?)
+            """, (user_id, category, items[0][0], items[-1][0], len(items), payload))
+        unindex_rows(conn, [(row[0], row[1], row[3], row[4]) for row in rows])
+        conn.executemany("DELETE FROM interactions WHERE id = ?", [(row[0],) for row in rows])
+        conn.execute("COMMIT")
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+    return len(rows)
+
+
+def _optimize(conn):
+    conn.execute("INSERT INTO interactions_fts (interactions_fts) VALUES ('optimize')")
+    conn.execute("PRAGMA optimize")
+
+
+async def read_archive(storage, user_id, category):
+    """Archived (id, user_message, bot_response, timestamp) rows, oldest first."""
+    rows = await storage.fetchall("""
+        SELECT payload FROM interactions_archive
+        WHERE user_id = ? AND category = ?
+        ORDER BY first_id
+    """, (user_id, category))
+    return [tuple(item) for (payload,) in rows for item in json.loads(zlib.decompress(payload))]
+
+
+class ArchiveJob:
+    """Periodically moves interactions older than retention_days into
+    interactions_archive as zlib-compressed JSON, one (user_id, category)
+    group per row, so the hot table and its FTS index stay small."""
+
+    def __init__(self, storage, retention_days: int = 90, interval: float = 6 * 3600, batch_size: int = 1000):
+        self.storage = storage
+        self.retention_days = retention_days
+        self.interval = interval
+        self.batch_size = batch_size
+        self._task = None
+
+    def start(self):
+        if self.retention_days <= 0:
+            return
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+
+    async def run_once(self) -> int:
+        archived = 0
+        while True:
+            count = await self.storage.run(lambda conn: _archive_batch(conn, self.retention_days, self.batch_size))
+            archived += count
+            if count < self.batch_size:
+                break
+            # Let other queries through between batches
+            await asyncio.sleep(0.1)
+        if archived:
+            await self.storage.run(_optimize)
+            logging.info(f"Перенесено в архив взаимодействий: {archived}")
+        return archived
+
+    async def _run(self):
+        while True:
+            try:
+                await self.run_once()
+            except Exception as e:
+                logging.error(f"Ошибка архивации истории: {e}")
+            await asyncio.sleep(self.interval)
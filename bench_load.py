@@ -0,0 +1,213 @@
+"""Offline load test of the real handlers from main.py.
+
+Usage: python bench_load.py [--users 2000] [--concurrency 200] [--rounds 1]
+                            [--openai-latency 0.3] [--openai-error-rate 0.02] [--output bench_results.json]
+
+Starts local fake Telegram Bot API and OpenAI servers (fake_servers.py),
+points main.py at them and a temporary database, and replays a synthetic
+session per simulated user: choose programming, ask, choose chat, talk,
+open the diary and add a task. Reports p50/p95/p99 latency per handler,
+messages/sec, event-loop lag and SQLite time, and writes everything to a
+JSON file so runs can be compared.
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import logging
+import os
+import random
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+from cryptography.fernet import Fernet
+
+from bench_storage import LagProbe
+from fake_servers import FakeOpenAI, FakeTelegram
+
+PROGRAMMING_QUESTIONS = [
+    "что такое список в python", "как работает async/await", "чем отличается tuple от list",
+    "как прочитать файл построчно", "что такое декоратор", "как отсортировать словарь по значению",
+    "зачем нужен virtualenv", "как работает GIL", "что такое генератор", "как написать unit-тест",
+]
+CHAT_MESSAGES = ["привет", "как дела?", "расскажи анекдот", "что посоветуешь посмотреть?", "спасибо!"]
+
+
+def configure_env(args, tmp_dir, telegram, openai_server):
+    # main.py reads all of this at import time
+    key = Fernet.generate_key()
+    cipher = Fernet(key)
+    os.environ.update({
+        "ENCRYPTION_KEY": key.decode(),
+        "ENCRYPTED_TELEGRAM_TOKEN": cipher.encrypt(b"123456:bench").decode(),
+        "ENCRYPTED_OPENAI_API_KEY": cipher.encrypt(b"sk-bench").decode(),
+        "BOT_DB_PATH": os.path.join(tmp_dir, "bench.db"),
+        "TELEGRAM_BASE_URL": telegram.url,
+        "OPENAI_API_BASE": f"{openai_server.url}/v1",
+        "STREAM_REPLIES": "1" if args.stream else "0",
+    })
+    # Measure the bot, not our own rate limiter, unless asked to
+    os.environ.setdefault("OPENAI_RPM", "1000000")
+    os.environ.setdefault("OPENAI_TPM", "1000000000")
+    os.environ.setdefault("OPENAI_MAX_QUEUE", "100000")
+    os.environ.setdefault("OPENAI_MAX_CONCURRENCY", str(args.concurrency))
+    os.environ.setdefault("STREAM_EDIT_INTERVAL", "0.5")
+
+
+def user(chat_id):
+    return {"id": chat_id, "is_bot": False, "first_name": f"User{chat_id}"}
+
+
+def text_update(update_id, chat_id, text):
+    return {"update_id": update_id, "message": {
+        "message_id": update_id, "date": int(time.time()), "chat": {"id": chat_id, "type": "private"},
+        "from": user(chat_id), "text": text,
+    }}
+
+
+def callback_update(update_id, chat_id, data):
+    return {"update_id": update_id, "callback_query": {
+        "id": str(update_id), "from": user(chat_id), "chat_instance": str(chat_id), "data": data,
+        "message": {"message_id": update_id, "date": int(time.time()), "chat": {"id": chat_id, "type": "private"},
+                    "text": "Выберите категорию:"},
+    }}
+
+
+def session(chat_id, update_ids):
+    task_time = (datetime.now() + timedelta(days=1)).strftime("%Y-%m-%d %H:%M")
+    return [
+        ("button_handler", callback_update(next(update_ids), chat_id, "programming")),
+        ("programming", text_update(next(update_ids), chat_id, random.choice(PROGRAMMING_QUESTIONS))),
+        ("button_handler", callback_update(next(update_ids), chat_id, "chat")),
+        ("chat", text_update(next(update_ids), chat_id, random.choice(CHAT_MESSAGES))),
+        ("button_handler", callback_update(next(update_ids), chat_id, "diary")),
+        ("add_task", text_update(next(update_ids), chat_id, f"Задача {chat_id} | {task_time}")),
+    ]
+
+
+def percentiles(samples):
+    if not samples:
+        return {"count": 0}
+    samples = sorted(samples)
+
+    def pick(q):
+        return samples[min(len(samples) - 1, int(q * len(samples)))] * 1000
+
+    return {
+        "count": len(samples),
+        "mean_ms": sum(samples) / len(samples) * 1000,
+        "p50_ms": pick(0.50),
+        "p95_ms": pick(0.95),
+        "p99_ms": pick(0.99),
+        "max_ms": samples[-1] * 1000,
+    }
+
+
+async def run(args, telegram, openai_server):
+    import main
+    from telegram import Update
+
+    logging.getLogger().setLevel(logging.WARNING)
+    main.initialize_db()
+    main.storage.start()
+    app = main.build_application()
+    await app.initialize()
+
+    latencies = {}
+    update_ids = itertools.count(1)
+    semaphore = asyncio.Semaphore(args.concurrency)
+
+    async def simulate(chat_id):
+        async with semaphore:
+            for _ in range(args.rounds):
+                for label, data in session(chat_id, update_ids):
+                    update = Update.de_json(data, app.bot)
+                    started = time.perf_counter()
+                    await app.process_update(update)
+                    latencies.setdefault(label, []).append(time.perf_counter() - started)
+                    if args.think_ms:
+                        await asyncio.sleep(random.uniform(0, args.think_ms / 1000))
+
+    probe = LagProbe(interval=0.01)
+    probe.start()
+    started = time.perf_counter()
+    await asyncio.gather(*(simulate(100000 + i) for i in range(args.users)))
+    elapsed = time.perf_counter() - started
+    await probe.stop()
+
+    await app.shutdown()
+    await main.storage.flush()
+    storage_stats = main.storage.stats()
+    cache_stats = main.completion_cache.stats()
+    upstream_stats = main.upstream.stats()
+    await main.close_services()
+
+    total = sum(len(samples) for samples in latencies.values())
+    return {
+        "config": vars(args),
+        "elapsed_s": elapsed,
+        "messages": total,
+        "messages_per_sec": total / elapsed,
+        "handlers": {label: percentiles(samples) for label, samples in sorted(latencies.items())},
+        "all": percentiles([s for samples in latencies.values() for s in samples]),
+        "event_loop_lag": {"max_ms": probe.max_lag * 1000, "total_ms": probe.total_lag * 1000},
+        "sqlite": storage_stats,
+        "completion_cache": cache_stats,
+        "upstream": upstream_stats,
+        "telegram": {"requests": telegram.requests, "injected_errors": telegram.errors,
+                     "error_replies": telegram.error_replies, "calls": telegram.calls},
+        "openai": {"requests": openai_server.requests, "completions": openai_server.completions,
+                   "injected_errors": openai_server.errors, "prompt_chars": openai_server.prompt_chars},
+    }
+
+
+def print_report(results):
+    print(f"{results['messages']} messages in {results['elapsed_s']:.1f} s: {results['messages_per_sec']:.0f} msg/s")
+    for label, stats in list(results["handlers"].items()) + [("all", results["all"])]:
+        print(f"  {label:>15}: n={stats['count']:6d}  p50 {stats['p50_ms']:8.1f} ms  "
+              f"p95 {stats['p95_ms']:8.1f} ms  p99 {stats['p99_ms']:8.1f} ms")
+    lag = results["event_loop_lag"]
+    print(f"  event loop lag: max {lag['max_ms']:.1f} ms, total {lag['total_ms']:.1f} ms")
+    sqlite = results["sqlite"]
+    print(f"  sqlite: {sqlite['commits']} commits {sqlite['commit_seconds'] * 1000:.1f} ms, "
+          f"{sqlite['queries']} queries {sqlite['query_seconds'] * 1000:.1f} ms")
+    print(f"  telegram error replies: {results['telegram']['error_replies']}, "
+          f"cache hit rate: {results['completion_cache']['hit_rate']:.2f}")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--users", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, default=200)
+    parser.add_argument("--rounds", type=int, default=1)
+    parser.add_argument("--think-ms", type=float, default=0)
+    parser.add_argument("--stream", action=argparse.BooleanOptionalAction, default=True)
+    parser.add_argument("--telegram-latency", type=float, default=0.02)
+    parser.add_argument("--telegram-error-rate", type=float, default=0.0)
+    parser.add_argument("--openai-latency", type=float, default=0.3)
+    parser.add_argument("--openai-token-latency", type=float, default=0.005)
+    parser.add_argument("--openai-error-rate", type=float, default=0.0)
+    parser.add_argument("--openai-error-status", type=int, default=429)
+    parser.add_argument("--output", default="bench_results.json")
+    args = parser.parse_args()
+
+    telegram = FakeTelegram(latency=args.telegram_latency, jitter=args.telegram_latency,
+                            error_rate=args.telegram_error_rate).start()
+    openai_server = FakeOpenAI(latency=args.openai_latency, jitter=args.openai_latency / 2,
+                               token_latency=args.openai_token_latency, error_rate=args.openai_error_rate,
+                               error_status=args.openai_error_status).start()
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        configure_env(args, tmp_dir, telegram, openai_server)
+        results = asyncio.run(run(args, telegram, openai_server))
+    telegram.stop()
+    openai_server.stop()
+
+    print_report(results)
+    with open(args.output, "w") as f:
+        json.dump(results, f, indent=2, ensure_ascii=False)
+    print(f"Results written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
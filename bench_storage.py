@@ -0,0 +1,152 @@
+"""Compare per-call sqlite3.connect persistence with the Storage thread.
+
+Usage: python bench_storage.py [--count 2000] [--users 50]
+
+Reports inserts/sec and how long the event loop was stalled while the
+inserts ran (max and total lag seen by a 1 ms ticker).
+"""
+import argparse
+import asyncio
+import os
+import sqlite3
+import tempfile
+import time
+
+from storage import Storage
+
+SCHEMA = """
+    CREATE TABLE IF NOT EXISTS interactions (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER NOT NULL,
+        category TEXT NOT NULL,
+        user_message TEXT NOT NULL,
+        bot_response TEXT NOT NULL,
+        timestamp DATETIME DEFAULT CURRENT_TIMESTAMP
+    )
+"""
+
+INSERT_SQL = """
+    INSERT INTO interactions (user_id, category, user_message, bot_response)
+    VALUES (?, ?, ?, ?)
+"""
+
+SELECT_SQL = """
+    SELECT user_message, bot_response FROM interactions
+    WHERE user_id = ? AND category = ?
+"""
+
+
+def make_db(path, with_index):
+    conn = sqlite3.connect(path)
+    conn.execute(SCHEMA)
+    if with_index:
+        conn.execute("CREATE INDEX idx_interactions_user_category ON interactions (user_id, category, id)")
+    conn.commit()
+    conn.close()
+
+
+# The code path main.py used before the Storage thread
+def legacy_save(path, *row):
+    conn = sqlite3.connect(path)
+    conn.execute(INSERT_SQL, row)
+    conn.commit()
+    conn.close()
+
+
+def legacy_get(path, user_id, category):
+    conn = sqlite3.connect(path)
+    rows = conn.execute(SELECT_SQL, (user_id, category)).fetchall()
+    conn.close()
+    return rows
+
+
+class LagProbe:
+    def __init__(self, interval=0.001):
+        self.interval = interval
+        self.max_lag = 0.0
+        self.total_lag = 0.0
+        self._task = None
+
+    async def _run(self):
+        while True:
+            start = time.perf_counter()
+            await asyncio.sleep(self.interval)
+            lag = time.perf_counter() - start - self.interval
+            if lag > 0:
+                self.max_lag = max(self.max_lag, lag)
+                self.total_lag += lag
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+
+
+def rows(count, users):
+    for i in range(count):
+        yield i % users, "programming", f"Вопрос {i}", f"Ответ {i} " * 20
+
+
+async def bench_legacy(path, count, users):
+    probe = LagProbe()
+    probe.start()
+    start = time.perf_counter()
+    for row in rows(count, users):
+        legacy_save(path, *row)
+        await asyncio.sleep(0)
+    elapsed = time.perf_counter() - start
+    for user_id in range(users):
+        legacy_get(path, user_id, "programming")
+        await asyncio.sleep(0)
+    await probe.stop()
+    return elapsed, probe
+
+
+async def bench_storage(path, count, users):
+    storage = Storage(path)
+    storage.start()
+    probe = LagProbe()
+    probe.start()
+    start = time.perf_counter()
+    for row in rows(count, users):
+        await storage.write(INSERT_SQL, row)
+        await asyncio.sleep(0)
+    await storage.flush()
+    elapsed = time.perf_counter() - start
+    for user_id in range(users):
+        await storage.fetchall(SELECT_SQL, (user_id, "programming"))
+    await probe.stop()
+    storage.close()
+    return elapsed, probe
+
+
+def report(name, count, elapsed, probe):
+    print(f"{name:>8}: {count / elapsed:10.0f} inserts/sec  "
+          f"max stall {probe.max_lag * 1000:8.2f} ms  total stall {probe.total_lag * 1000:9.2f} ms")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--count", type=int, default=2000)
+    parser.add_argument("--users", type=int, default=50)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        legacy_path = os.path.join(tmp, "legacy.db")
+        storage_path = os.path.join(tmp, "storage.db")
+        make_db(legacy_path, with_index=False)
+        make_db(storage_path, with_index=True)
+
+        elapsed, probe = asyncio.run(bench_legacy(legacy_path, args.count, args.users))
+        report("legacy", args.count, elapsed, probe)
+        elapsed, probe = asyncio.run(bench_storage(storage_path, args.count, args.users))
+        report("storage", args.count, elapsed, probe)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,112 @@
+"""Post fake Telegram updates to WebhookDispatcher and measure throughput.
+
+Usage: python bench_webhook.py [--updates 2000] [--chats 500] [--work-ms 2] [--workers 1 2 4]
+
+Each worker burns --work-ms of CPU per update (a stand-in for handler
+work), so updates/sec should grow with the number of worker processes.
+The run also checks that every chat was served by a single worker in
+the order its updates were posted.
+"""
+import argparse
+import asyncio
+import json
+import multiprocessing
+import time
+
+from webhook import WebhookDispatcher, chat_id_of, iter_updates
+
+
+def fake_update(update_id, chat_id, seq):
+    return {
+        "update_id": update_id,
+        "message": {
+            "message_id": seq,
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private"},
+            "from": {"id": chat_id, "is_bot": False, "first_name": "Test"},
+            "text": f"сообщение {seq}",
+        },
+    }
+
+
+def bench_worker(index, updates, processed, work_seconds, violations):
+    async def run():
+        last_seen = {}
+        async for data in iter_updates(updates):
+            update = json.loads(data)
+            chat_id = chat_id_of(update)
+            seq = update["message"]["message_id"]
+            if last_seen.get(chat_id, -1) >= seq:
+                with violations.get_lock():
+                    violations.value += 1
+            last_seen[chat_id] = seq
+
+            deadline = time.perf_counter() + work_seconds
+            while time.perf_counter() < deadline:
+                pass
+            with processed.get_lock():
+                processed.value += 1
+
+    asyncio.run(run())
+
+
+async def post_updates(port, path, updates, connections):
+    # Telegram delivers one chat's updates one at a time, so each chat sticks to one connection
+    buckets = [[] for _ in range(connections)]
+    for update in updates:
+        buckets[chat_id_of(update) % connections].append(update)
+
+    async def poster(bucket):
+        reader, writer = await asyncio.open_connection("127.0.0.1", port)
+        for update in bucket:
+            body = json.dumps(update).encode()
+            writer.write(
+                f"POST {path} HTTP/1.1\r\nHost: localhost\r\nContent-Type: application/json\r\n"
+                f"Content-Length: {len(body)}\r\n\r\n".encode() + body
+            )
+            await writer.drain()
+            status = await reader.readline()
+            assert b"200" in status, status
+            while (await reader.readline()) not in (b"\r\n", b""):
+                pass
+        writer.close()
+
+    await asyncio.gather(*(poster(bucket) for bucket in buckets))
+
+
+async def run_once(workers, count, chats, work_ms):
+    ctx = multiprocessing.get_context("spawn")
+    processed = ctx.Value("i", 0)
+    violations = ctx.Value("i", 0)
+    dispatcher = WebhookDispatcher(
+        bench_worker, workers=workers, host="127.0.0.1", port=0,
+        worker_args=(processed, work_ms / 1000, violations),
+    )
+    await dispatcher.start()
+    updates = [fake_update(i, 1000 + i % chats, i) for i in range(count)]
+    start = time.perf_counter()
+    await post_updates(dispatcher.port, dispatcher.path, updates, connections=min(chats, 40))
+    while processed.value < count:
+        await asyncio.sleep(0.005)
+    elapsed = time.perf_counter() - start
+    await dispatcher.stop()
+    return count / elapsed, violations.value
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--updates", type=int, default=2000)
+    parser.add_argument("--chats", type=int, default=500)
+    parser.add_argument("--work-ms", type=float, default=2.0)
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4])
+    args = parser.parse_args()
+
+    baseline = None
+    for workers in args.workers:
+        rate, violations = asyncio.run(run_once(workers, args.updates, args.chats, args.work_ms))
+        baseline = baseline or rate
+        print(f"{workers} worker(s): {rate:8.0f} updates/sec  x{rate / baseline:.2f}  ordering violations: {violations}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,193 @@
+import asyncio
+import logging
+from collections import OrderedDict
+
+try:
+    import tiktoken
+    _encoding = tiktoken.get_encoding("cl100k_base")
+except ImportError:
+    _encoding = None
+
+# Rough per-message overhead of the chat format
+MESSAGE_OVERHEAD_TOKENS = 4
+
+
+def count_tokens(text: str) -> int:
+    if not text:
+        return 0
+    if _encoding is not None:
+        return len(_encoding.encode(text))
+    # Without tiktoken: ~3 characters per token is conservative for Russian text
+    return len(text) // 3 + 1
+
+
+def turn_tokens(user_message: str, bot_response: str) -> int:
+    return count_tokens(user_message) + count_tokens(bot_response) + 2 * MESSAGE_OVERHEAD_TOKENS
+
+
+class ContextBuilder:
+    """Builds chat messages from the newest Q&A pairs that fit a token budget.
+
+    Turns that no longer fit are folded into a rolling summary stored per
+    (user_id, category); the summary remembers the last interaction id it
+    covers, so each turn is summarized only once. Folding runs in the
+    background once the turns left out exceed fold_tokens (half the budget
+    by default), so replies never wait on it. With retrieve_k, up to k
+    older exchanges most relevant to the new message are added as well.
+    """
+
+    def __init__(self, storage, summarize, budget_tokens: int = 2000, summary_tokens: int = 300,
+                 cache_size: int = 1024, fetch_limit: int = 200, retrieve=None, retrieval_tokens: int = 500,
+                 fold_tokens: int = None):
+        self.storage = storage
+        self.summarize = summarize
+        self.budget_tokens = budget_tokens
+        self.summary_tokens = summary_tokens
+        self.retrieve = retrieve
+        self.retrieval_tokens = retrieval_tokens
+        self.cache_size = cache_size
+        self.fetch_limit = fetch_limit
+        self.fold_tokens = fold_tokens
+        self._summaries = OrderedDict()
+        self._folding = {}
+
+    async def build(self, user_id, category, system_prompt: str, user_message: str, budget_tokens: int = None,
+                    retrieve_k: int = 0):
+        budget = self.budget_tokens if budget_tokens is None else budget_tokens
+        messages = [{"role": "system", "content": system_prompt}]
+        if budget <= 0:
+            messages.append({"role": "user", "content": user_message})
+            return messages
+
+        summary, last_id = await self._get_summary(user_id, category)
+        rows = await self.storage.fetchall("""
+            SELECT id, user_message, bot_response FROM interactions
+            WHERE user_id = ? AND category = ? AND id > ?
+            ORDER BY id DESC
+            LIMIT ?
+        """, (user_id, category, last_id, self.fetch_limit))
+
+        retrieving = retrieve_k > 0 and self.retrieve is not None
+        # Newest turns first, until the budget (minus room for the summary and retrieval) is spent
+        available = budget - self.summary_tokens - count_tokens(user_message)
+        if retrieving:
+            available -= self.retrieval_tokens
+        kept = []
+        for row in rows:
+            cost = turn_tokens(row[1], row[2])
+            if cost > available:
+                break
+            kept.append(row)
+            available -= cost
+
+        overflow = rows[len(kept):]
+        if overflow:
+            # A full page may have more unsummarized rows behind it
+            fold_tokens = budget // 2 if self.fold_tokens is None else self.fold_tokens
+            if len(rows) == self.fetch_limit or sum(turn_tokens(r[1], r[2]) for r in overflow) >= fold_tokens:
+                self._schedule_fold(user_id, category, overflow[0][0], budget)
+
+        if summary:
+            messages.append({"role": "system", "content": f"Краткое содержание предыдущего диалога:\n{summary}"})
+        if retrieving:
+            related = await self._related(user_id, category, user_message, retrieve_k, {row[0] for row in kept})
+            if related:
+                messages.append({"role": "system", "content": "Похожие прошлые вопросы пользователя:\n" + related})
+        for _, question, answer in reversed(kept):
+            messages.append({"role": "user", "content": question})
+            messages.append({"role": "assistant", "content": answer})
+        messages.append({"role": "user", "content": user_message})
+        return messages
+
+    async def stop(self):
+        tasks = list(self._folding.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def _related(self, user_id, category, user_message, k, exclude_ids):
+        try:
+            rows = await self.retrieve(user_id, category, user_message, k + len(exclude_ids))
+        except Exception as e:
+            logging.error(f"Ошибка поиска по истории для {user_id}/{category}: {e}")
+            return ""
+        lines, available = [], self.retrieval_tokens
+        for turn_id, question, answer in rows:
+            if turn_id in exclude_ids:
+                continue
+            cost = turn_tokens(question, answer)
+            if cost > available:
+                continue
+            lines.append(f"Вопрос: {question} Ответ: {answer}")
+            available -= cost
+            if len(lines) == k:
+                break
+        return "\n".join(lines)
+
+    async def _get_summary(self, user_id, category):
+        key = (user_id, category)
+        if key in self._summaries:
+            self._summaries.move_to_end(key)
+            return self._summaries[key]
+        rows = await self.storage.fetchall("""
+            SELECT summary, last_id FROM summaries
+            WHERE user_id = ? AND category = ?
+        """, (user_id, category))
+        value = rows[0] if rows else ("", 0)
+        self._remember(key, value)
+        return value
+
+    def _remember(self, key, value):
+        self._summaries[key] = value
+        self._summaries.move_to_end(key)
+        while len(self._summaries) > self.cache_size:
+            self._summaries.popitem(last=False)
+
+    def _schedule_fold(self, user_id, category, until_id, chunk_tokens):
+        key = (user_id, category)
+        if key in self._folding:
+            return
+        task = asyncio.create_task(self._fold(user_id, category, until_id, chunk_tokens))
+        self._folding[key] = task
+        task.add_done_callback(lambda _: self._folding.pop(key, None))
+
+    async def _fold(self, user_id, category, until_id, chunk_tokens):
+        """Fold every unsummarized turn up to until_id, oldest first, page by page."""
+        summary, last_id = await self._get_summary(user_id, category)
+        while last_id < until_id:
+            rows = await self.storage.fetchall("""
+                SELECT id, user_message, bot_response FROM interactions
+                WHERE user_id = ? AND category = ? AND id > ? AND id <= ?
+                ORDER BY id
+                LIMIT ?
+            """, (user_id, category, last_id, until_id, self.fetch_limit))
+            if not rows:
+                break
+
+            # Summarize in chunks so a long backlog never produces an oversized prompt
+            chunks, size = [], 0
+            for turn in rows:
+                cost = turn_tokens(turn[1], turn[2])
+                if chunks and size + cost <= chunk_tokens:
+                    chunks[-1].append(turn)
+                    size += cost
+                else:
+                    chunks.append([turn])
+                    size = cost
+
+            for chunk in chunks:
+                try:
+                    summary = await self.summarize(summary, [(q, a) for _, q, a in chunk], self.summary_tokens)
+                except Exception as e:
+                    logging.error(f"Ошибка при сжатии истории для {user_id}/{category}: {e}")
+                    return
+                last_id = chunk[-1][0]
+                await self.storage.write("""
+                    INSERT INTO summaries (user_id, category, summary, last_id)
+                    VALUES (?, ?, ?, ?)
+                    ON CONFLICT (user_id, category) DO UPDATE SET
+                        summary = excluded.summary,
+                        last_id = excluded.last_id,
+                        updated_at = CURRENT_TIMESTAMP
+                """, (user_id, category, summary, last_id))
+                self._remember((user_id, category), (summary, last_id))
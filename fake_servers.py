@@ -0,0 +1,175 @@
+"""Local stand-ins for the Telegram Bot API and the OpenAI API.
+
+Both servers answer with configurable latency and inject errors at a
+configurable rate; they are used by bench_load.py.
+"""
+import asyncio
+import itertools
+import json
+import random
+import threading
+import time
+from abc import ABC, abstractmethod
+from urllib.parse import parse_qs
+
+from httpserver import response_head, serve_connection, write_response
+
+BOT_USER = {"id": 1, "is_bot": True, "first_name": "Bot", "username": "bench_bot",
+            "can_join_groups": True, "can_read_all_group_messages": False, "supports_inline_queries": False}
+
+
+class FakeServer(ABC):
+    def __init__(self, latency: float = 0.0, jitter: float = 0.0, error_rate: float = 0.0, error_status: int = 500):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.port = None
+        self.requests = 0
+        self.errors = 0
+        self._loop = None
+        self._server = None
+        self._thread = None
+
+    def start(self):
+        # Runs on its own loop and thread so it does not skew the bot's event loop
+        ready = threading.Event()
+        self._thread = threading.Thread(target=self._run, args=(ready,), name=type(self).__name__, daemon=True)
+        self._thread.start()
+        ready.wait()
+        return self
+
+    def stop(self):
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.port}"
+
+    def _run(self, ready):
+        self._loop = asyncio.new_event_loop()
+        self._server = self._loop.run_until_complete(asyncio.start_server(
+            lambda reader, writer: serve_connection(reader, writer, self._handle), "127.0.0.1", 0
+        ))
+        self.port = self._server.sockets[0].getsockname()[1]
+        ready.set()
+        self._loop.run_forever()
+        self._server.close()
+
+    async def _delay(self):
+        delay = self.latency + random.uniform(0, self.jitter)
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    def _inject_error(self):
+        if self.error_rate and random.random() < self.error_rate:
+            self.errors += 1
+            return True
+        return False
+
+    @abstractmethod
+    async def _handle(self, request, writer):
+        """Write the whole response to the request."""
+
+
+class FakeTelegram(FakeServer):
+    """Answers the Bot API methods the handlers use and records sent texts."""
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self._message_ids = itertools.count(1000)
+        self.calls = {}
+        self.error_replies = 0
+
+    async def _handle(self, request, writer):
+        self.requests += 1
+        method = request.path.rsplit("/", 1)[-1]
+        self.calls[method] = self.calls.get(method, 0) + 1
+        if request.headers.get("content-type", "").startswith("application/json"):
+            params = json.loads(request.body or b"{}")
+        else:
+            params = {key: values[0] for key, values in parse_qs(request.body.decode()).items()}
+
+        await self._delay()
+        if self._inject_error():
+            body = {"ok": False, "error_code": self.error_status, "description": "Injected error"}
+            if self.error_status == 429:
+                body["parameters"] = {"retry_after": 1}
+            await write_response(writer, self.error_status, json.dumps(body).encode(), "application/json",
+                                 request.keep_alive)
+            return
+
+        result = self._result(method, params)
+        await write_response(writer, 200, json.dumps({"ok": True, "result": result}).encode(), "application/json",
+                             request.keep_alive)
+
+    def _result(self, method, params):
+        if method == "getMe":
+            return BOT_USER
+        if method in ("sendMessage", "editMessageText"):
+            text = params.get("text", "")
+            if text.startswith("Произошла ошибка"):
+                self.error_replies += 1
+            return {
+                "message_id": int(params.get("message_id") or next(self._message_ids)),
+                "date": int(time.time()),
+                "chat": {"id": int(params.get("chat_id", 0)), "type": "private"},
+                "from": BOT_USER,
+                "text": text,
+            }
+        return True
+
+
+class FakeOpenAI(FakeServer):
+    """Serves /v1/chat/completions, streamed or not.
+
+    latency is the time to the first token; token_latency is the gap
+    between streamed chunks.
+    """
+
+    def __init__(self, token_latency: float = 0.0, reply_words: int = 60, **kwargs):
+        super().__init__(**kwargs)
+        self.token_latency = token_latency
+        self.reply_words = reply_words
+        self.completions = 0
+        self.prompt_chars = 0
+
+    async def _handle(self, request, writer):
+        self.requests += 1
+        payload = json.loads(request.body or b"{}")
+        self.prompt_chars += sum(len(m.get("content", "")) for m in payload.get("messages", []))
+        await self._delay()
+        if self._inject_error():
+            body = {"error": {"message": "Injected error", "type": "server_error" if self.error_status >= 500
+                              else "rate_limit_exceeded"}}
+            await write_response(writer, self.error_status, json.dumps(body).encode(), "application/json",
+                                 request.keep_alive)
+            return
+
+        self.completions += 1
+        words = [f"слово{i}" for i in range(self.reply_words)]
+        base = {"id": f"chatcmpl-{self.completions}", "created": int(time.time()), "model": payload.get("model")}
+        if not payload.get("stream"):
+            body = dict(base, object="chat.completion", choices=[{
+                "index": 0, "message": {"role": "assistant", "content": " ".join(words)}, "finish_reason": "stop",
+            }], usage={"prompt_tokens": 0, "completion_tokens": len(words), "total_tokens": len(words)})
+            await write_response(writer, 200, json.dumps(body).encode(), "application/json", request.keep_alive)
+            return
+
+        writer.write(response_head(200, "text/event-stream", keep_alive=request.keep_alive, chunked=True))
+        for i, word in enumerate(words):
+            chunk = dict(base, object="chat.completion.chunk", choices=[{
+                "index": 0, "delta": {"content": word if i == 0 else " " + word}, "finish_reason": None,
+            }])
+            self._write_chunk(writer, f"data: {json.dumps(chunk)}\n\n".encode())
+            await writer.drain()
+            if self.token_latency:
+                await asyncio.sleep(self.token_latency)
+        self._write_chunk(writer, b"data: [DONE]\n\n")
+        self._write_chunk(writer, b"")
+        await writer.drain()
+
+    @staticmethod
+    def _write_chunk(writer, data):
+        writer.write(f"{len(data):x}\r\n".encode() + data + b"\r\n")
@@ -0,0 +1,131 @@
+import re
+
+MAX_QUERY_TERMS = 16
+SNIPPET_WORDS = 24
+
+# Runs of letters and digits, the same the unicode61 tokenizer keeps together
+_WORD = re.compile(r"[^\W_]+")
+
+
+def _words(text: str):
+    return _WORD.findall(text.lower())
+
+
+def owner_prefix(user_id) -> str:
+    """Fixed-width prefix glued to every indexed word of one chat.
+
+    Each chat's words are separate FTS5 terms, so a lookup reads only that
+    chat's terms and postings however large the whole index grows.
+    """
+    return f"{'n' if user_id < 0 else 'p'}{abs(int(user_id)):015d}"
+
+
+def index_terms(user_id, user_message: str, bot_response: str) -> str:
+    """Text stored in interactions_fts for one interaction."""
+    prefix = owner_prefix(user_id)
+    return " ".join(prefix + word for word in _words(f"{user_message} {bot_response}"))
+
+
+def query_terms(text: str):
+    # Long words lose their last two letters before prefix matching, a crude
+    # way to match other Russian endings ("декораторы" finds "декоратор")
+    terms = []
+    for word in _words(text):
+        if len(word) > 5:
+            word = word[:-2]
+        if len(word) >= 2 and word not in terms:
+            terms.append(word)
+    return terms[:MAX_QUERY_TERMS]
+
+
+def build_match_query(text: str, user_id):
+    """Turn free text into an FTS5 query over one chat's words: every word,
+    prefix-matched, OR-ed.
+
+    Quoting keeps user input from being parsed as FTS5 syntax. Returns None
+    if there is nothing to search.
+    """
+    terms = query_terms(text)
+    if not terms:
+        return None
+    prefix = owner_prefix(user_id)
+    return " OR ".join(f'"{prefix}{term}"*' for term in terms)
+
+
+def make_snippet(text: str, terms, size: int = SNIPPET_WORDS) -> str:
+    """Up to size words of text around the first match, matches in «»."""
+    def matches(word):
+        return any(part.startswith(term) for part in _words(word) for term in terms)
+
+    words = text.split()
+    first = next((i for i, word in enumerate(words) if matches(word)), 0)
+    start = max(0, min(first - size // 4, len(words) - size))
+    window = words[start:start + size]
+    snippet = " ".join(f"«{word}»" if matches(word) else word for word in window)
+    return ("…" if start > 0 else "") + snippet + ("…" if start + size < len(words) else "")
+
+
+def index_history(conn, batch_size: int = 1000):
+    """Index every interaction; used once when interactions_fts is created."""
+    last_id = 0
+    while True:
+        rows = conn.execute("""
+            SELECT id, user_id, user_message, bot_response FROM interactions
+            WHERE id > ?
+            ORDER BY id
+            LIMIT ?
+        """, (last_id, batch_size)).fetchall()
+        if not rows:
+            return
+        conn.executemany(
+            "INSERT INTO interactions_fts (rowid, terms) VALUES (?, ?)",
+            [(row[0], index_terms(row[1], row[2], row[3])) for row in rows],
+        )
+        last_id = rows[-1][0]
+
+
+def unindex_rows(conn, rows):
+    """Drop (id, user_id, user_message, bot_response) rows from interactions_fts.
+
+    The index is contentless, so a delete repeats the indexed text.
+    """
+    conn.executemany(
+        "INSERT INTO interactions_fts (interactions_fts, rowid, terms) VALUES ('delete', ?, ?)",
+        [(row[0], index_terms(row[1], row[2], row[3])) for row in rows],
+    )
+
+
+class HistorySearch:
+    """BM25-ranked search over interactions through the interactions_fts index."""
+
+    def __init__(self, storage):
+        self.storage = storage
+
+    async def search(self, user_id, text: str, limit: int = 5):
+        query = build_match_query(text, user_id)
+        if query is None:
+            return []
+        rows = await self.storage.fetchall("""
+            SELECT interactions.id, category, user_message, bot_response
+            FROM interactions_fts
+            JOIN interactions ON interactions.id = interactions_fts.rowid
+            WHERE interactions_fts MATCH ? AND user_id = ?
+            ORDER BY bm25(interactions_fts)
+            LIMIT ?
+        """, (query, user_id, limit))
+        terms = query_terms(text)
+        return [(turn_id, category, question, make_snippet(answer, terms))
+                for turn_id, category, question, answer in rows]
+
+    async def relevant(self, user_id, category, text: str, limit: int = 3):
+        query = build_match_query(text, user_id)
+        if query is None:
+            return []
+        return await self.storage.fetchall("""
+            SELECT interactions.id, user_message, bot_response
+            FROM interactions_fts
+            JOIN interactions ON interactions.id = interactions_fts.rowid
+            WHERE interactions_fts MATCH ? AND user_id = ? AND category = ?
+            ORDER BY bm25(interactions_fts)
+            LIMIT ?
+        """, (query, user_id, category, limit))
@@ -0,0 +1,92 @@
+import asyncio
+
+REASONS = {
+    200: "OK",
+    400: "Bad Request",
+    403: "Forbidden",
+    404: "Not Found",
+    413: "Payload Too Large",
+    429: "Too Many Requests",
+    500: "Internal Server Error",
+    502: "Bad Gateway",
+    503: "Service Unavailable",
+}
+
+
+class Request:
+    def __init__(self, method, target, version, headers, body):
+        self.method = method
+        self.target = target
+        self.path = target.split("?")[0]
+        self.version = version
+        self.headers = headers
+        self.body = body
+
+    @property
+    def keep_alive(self):
+        return self.version == "HTTP/1.1" and self.headers.get("connection", "").lower() != "close"
+
+
+class PayloadTooLarge(Exception):
+    pass
+
+
+async def read_request(reader, max_body: int = 1 << 20):
+    """Read one HTTP/1.x request; returns None when the client closed the connection."""
+    request_line = await reader.readline()
+    if not request_line:
+        return None
+    method, target, version = request_line.decode("latin-1").split()
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b"\r\n", b"\n", b""):
+            break
+        name, _, value = line.decode("latin-1").partition(":")
+        headers[name.strip().lower()] = value.strip()
+
+    length = int(headers.get("content-length", 0))
+    if length > max_body:
+        raise PayloadTooLarge()
+    body = await reader.readexactly(length) if length else b""
+    return Request(method, target, version, headers, body)
+
+
+def response_head(status: int, content_type: str = None, length: int = None, keep_alive: bool = True, chunked=False):
+    lines = [f"HTTP/1.1 {status} {REASONS.get(status, '')}"]
+    if content_type:
+        lines.append(f"Content-Type: {content_type}")
+    if chunked:
+        lines.append("Transfer-Encoding: chunked")
+    else:
+        lines.append(f"Content-Length: {length or 0}")
+    lines.append(f"Connection: {'keep-alive' if keep_alive else 'close'}")
+    return ("\r\n".join(lines) + "\r\n\r\n").encode()
+
+
+async def write_response(writer, status: int, body: bytes = b"", content_type: str = None, keep_alive: bool = True):
+    writer.write(response_head(status, content_type, len(body), keep_alive) + body)
+    await writer.drain()
+
+
+async def serve_connection(reader, writer, handle, max_body: int = 1 << 20):
+    """Serve keep-alive requests on one connection.
+
+    handle(request, writer) writes the whole response itself.
+    """
+    try:
+        while True:
+            try:
+                request = await read_request(reader, max_body)
+            except PayloadTooLarge:
+                await write_response(writer, 413, keep_alive=False)
+                break
+            if request is None:
+                break
+            await handle(request, writer)
+            if not request.keep_alive:
+                break
+    except (asyncio.IncompleteReadError, ConnectionError, ValueError):
+        pass
+    finally:
+        writer.close()
@@ -0,0 +1,138 @@
+import asyncio
+import hashlib
+import json
+import time
+from collections import OrderedDict
+
+
+def normalize_message(text: str) -> str:
+    return " ".join(text.lower().split())
+
+
+class CompletionCache:
+    """TTL + LRU cache for completions with single-flight coalescing.
+
+    With a storage attached, entries are also kept in the llm_cache table
+    so they survive restarts. Exceptions listed in private_errors concern
+    only the caller that raised them (e.g. a per-user limit): requests
+    coalesced onto it call create themselves instead of failing too.
+    """
+
+    def __init__(self, max_entries: int = 1024, ttl: float = 3600, storage=None, cleanup_every: int = 500,
+                 private_errors=()):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.storage = storage
+        self.private_errors = tuple(private_errors)
+        self.cleanup_every = cleanup_every
+        self._entries = OrderedDict()
+        self._in_flight = {}
+        self._writes = 0
+        self.hits = 0
+        self.persistent_hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.evictions = 0
+
+    @staticmethod
+    def make_key(model: str, messages, normalize: bool = True) -> str:
+        """Key over the model and every message.
+
+        Only the new (last) message is normalized, and only with normalize:
+        case and whitespace can matter in code, so context is hashed as is.
+        """
+        *context, last = messages
+        content = normalize_message(last["content"]) if normalize else last["content"].strip()
+        payload = [model] + [[m["role"], m["content"]] for m in context] + [[last["role"], content]]
+        return hashlib.sha256(json.dumps(payload, ensure_ascii=False).encode()).hexdigest()
+
+    async def get_or_create(self, key: str, create):
+        while True:
+            value = self._get(key)
+            if value is not None:
+                self.hits += 1
+                return value
+
+            if key not in self._in_flight:
+                break
+            self.coalesced += 1
+            try:
+                return await asyncio.shield(self._in_flight[key])
+            except self.private_errors:
+                # The leader's own failure: try again, possibly as the new leader
+                continue
+
+        future = asyncio.get_running_loop().create_future()
+        # Nobody may be waiting on it; don't warn about an unretrieved error
+        future.add_done_callback(lambda f: f.cancelled() or f.exception())
+        self._in_flight[key] = future
+        try:
+            value = await self._get_persistent(key)
+            if value is not None:
+                self.persistent_hits += 1
+            else:
+                self.misses += 1
+                value = await create()
+                await self._put_persistent(key, value)
+            self._put(key, value)
+            future.set_result(value)
+            return value
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except Exception as e:
+            future.set_exception(e)
+            raise
+        finally:
+            del self._in_flight[key]
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.persistent_hits + self.misses + self.coalesced
+        return {
+            "entries": len(self._entries),
+            "in_flight": len(self._in_flight),
+            "hits": self.hits,
+            "persistent_hits": self.persistent_hits,
+            "misses": self.misses,
+            "coalesced": self.coalesced,
+            "evictions": self.evictions,
+            "hit_rate": (lookups - self.misses) / lookups if lookups else 0.0,
+        }
+
+    def _get(self, key):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        value, expires_at = entry
+        if expires_at < time.monotonic():
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return value
+
+    def _put(self, key, value):
+        self._entries[key] = (value, time.monotonic() + self.ttl)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    async def _get_persistent(self, key):
+        if self.storage is None:
+            return None
+        rows = await self.storage.fetchall("""
+            SELECT response FROM llm_cache
+            WHERE key = ? AND created_at > ?
+        """, (key, time.time() - self.ttl))
+        return rows[0][0] if rows else None
+
+    async def _put_persistent(self, key, value):
+        if self.storage is None:
+            return
+        await self.storage.write("""
+            INSERT OR REPLACE INTO llm_cache (key, response, created_at)
+            VALUES (?, ?, ?)
+        """, (key, value, time.time()))
+        self._writes += 1
+        if self._writes % self.cleanup_every == 0:
+            await self.storage.write("DELETE FROM llm_cache WHERE created_at <= ?", (time.time() - self.ttl,))
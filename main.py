@@ -1,5 +1,6 @@
 import logging
 import asyncio
+import json
 import os
 from datetime import datetime, timedelta
 import random
@@ -8,13 +9,24 @@ import sqlite3
 import openai
 from cryptography.fernet import Fernet
 import nest_asyncio
-from apscheduler.schedulers.asyncio import AsyncIOScheduler
-from apscheduler.triggers.date import DateTrigger
 from dotenv import load_dotenv
-from telegram import Update, InlineKeyboardMarkup, InlineKeyboardButton
+from telegram import Bot, Update, InlineKeyboardMarkup, InlineKeyboardButton
 from telegram.ext import ApplicationBuilder, CommandHandler, CallbackQueryHandler, MessageHandler, filters, ContextTypes
 from telegram.constants import ChatAction
 
+from archive import ArchiveJob
+from context_builder import ContextBuilder, count_tokens
+from history_search import HistorySearch, index_history, index_terms
+from llm_cache import CompletionCache
+from metrics import EVENT_LOOP_LAG, LoopLagMonitor, registry, start_metrics_server
+from persistence import SQLitePersistence
+from reminders import ReminderEngine
+from storage import Storage
+from streaming import replace_reply, send_text, stream_reply
+from update_processor import PerChatUpdateProcessor
+from upstream import OPENAI_SECONDS, Overloaded, UpstreamScheduler, UserBusy
+from webhook import WebhookDispatcher, iter_updates
+
 # Apply nest_asyncio for nested event loops
 nest_asyncio.apply()
 logging.basicConfig(level=logging.INFO)
@@ -46,16 +58,22 @@ except Exception as e:
     logging.error(f"Ошибка загрузки ключей: {e}")
     raise SystemExit("Не удалось загрузить зашифрованные ключи.")
 
-# APScheduler for reminders
-scheduler = AsyncIOScheduler()
+# SQLite storage (single connection on its own thread)
+DB_PATH = os.getenv("BOT_DB_PATH", "bot_data.db")
+storage = Storage(DB_PATH)
 
-# Task storage
-tasks = {}
+# Diary reminders, stored in the reminders table
+reminder_engine = ReminderEngine(
+    storage,
+    window=float(os.getenv("REMINDER_WINDOW", "3600")),
+    send_rate=int(os.getenv("REMINDER_SEND_RATE", "25")),
+)
+# How often the delivering webhook worker looks for reminders added by the others
+REMINDER_POLL_INTERVAL = float(os.getenv("REMINDER_POLL_INTERVAL", "5"))
 
-# Initialize database
 # Initialize database
 def initialize_db():
-    conn = sqlite3.connect("bot_data.db")
+    conn = sqlite3.connect(DB_PATH)
     cursor = conn.cursor()
 
     # Create the table if it does not exist
@@ -81,30 +99,267 @@ def initialize_db():
         cursor.execute("ALTER TABLE interactions ADD COLUMN user_message TEXT NOT NULL")
     if "bot_response" not in columns:
         cursor.execute("ALTER TABLE interactions ADD COLUMN bot_response TEXT NOT NULL")
-    conn.commit()
-    conn.close()
+    if "timestamp" not in columns:
+        # ALTER TABLE can't add a CURRENT_TIMESTAMP default; save_interaction sets it
+        cursor.execute("ALTER TABLE interactions ADD COLUMN timestamp DATETIME")
 
+    # History lookups filter by user and category and read in id order
+    cursor.execute("""
+        CREATE INDEX IF NOT EXISTS idx_interactions_user_category
+        ON interactions (user_id, category, id)
+    """)
 
-def save_interaction(user_id, category, user_message, bot_response):
-    conn = sqlite3.connect("bot_data.db")
-    cursor = conn.cursor()
+    # Full-text index over interactions. Contentless: its words carry the
+    # chat's prefix (see history_search.index_terms), so they are written by
+    # save_interaction and dropped by ArchiveJob rather than by triggers
+    cursor.execute("SELECT sql FROM sqlite_master WHERE name = 'interactions_fts'")
+    row = cursor.fetchone()
+    if row is not None and "terms" not in row[0]:
+        # Older index over everyone's words, filtered by user only after matching
+        for trigger in ("interactions_fts_insert", "interactions_fts_delete", "interactions_fts_update"):
+            cursor.execute(f"DROP TRIGGER IF EXISTS {trigger}")
+        cursor.execute("DROP TABLE interactions_fts")
+        row = None
     cursor.execute("""
-        INSERT INTO interactions (user_id, category, user_message, bot_response)
-        VALUES (?, ?, ?, ?)
-    """, (user_id, category, user_message, bot_response))
-    conn.commit()
-    conn.close()
+        CREATE VIRTUAL TABLE IF NOT EXISTS interactions_fts USING fts5(
+            terms, content = '', tokenize = 'unicode61 remove_diacritics 2'
+        )
+    """)
+    if row is None:
+        # Index the history saved before the index existed
+        index_history(conn)
 
-def get_user_queries(user_id, category):
-    conn = sqlite3.connect("bot_data.db")
-    cursor = conn.cursor()
+    # Compressed history moved out of interactions by ArchiveJob
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS interactions_archive (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            category TEXT NOT NULL,
+            first_id INTEGER NOT NULL,
+            last_id INTEGER NOT NULL,
+            row_count INTEGER NOT NULL,
+            payload BLOB NOT NULL, -- zlib-compressed JSON [[id, user_message, bot_response, timestamp], ...]
+            created_at DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+    cursor.execute("""
+        CREATE INDEX IF NOT EXISTS idx_interactions_archive_user
+        ON interactions_archive (user_id, category, first_id)
+    """)
+
+    # Rolling summaries of history that no longer fits the prompt budget
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS summaries (
+            user_id INTEGER NOT NULL,
+            category TEXT NOT NULL,
+            summary TEXT NOT NULL,
+            last_id INTEGER NOT NULL, -- last interaction folded into the summary
+            updated_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (user_id, category)
+        )
+    """)
+
+    # Persistent tier of the completion cache
     cursor.execute("""
-        SELECT user_message, bot_response FROM interactions
-        WHERE user_id = ? AND category = ?
-    """, (user_id, category))
-    rows = cursor.fetchall()
+        CREATE TABLE IF NOT EXISTS llm_cache (
+            key TEXT PRIMARY KEY,
+            response TEXT NOT NULL,
+            created_at REAL NOT NULL
+        )
+    """)
+
+    # Diary reminders; due_at is a Unix timestamp
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS reminders (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            chat_id INTEGER NOT NULL,
+            text TEXT NOT NULL,
+            due_at REAL NOT NULL,
+            status TEXT NOT NULL DEFAULT 'pending', -- pending, sending, sent, failed, cancelled
+            created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+            sent_at DATETIME
+        )
+    """)
+    cursor.execute("""
+        CREATE INDEX IF NOT EXISTS idx_reminders_pending_due
+        ON reminders (due_at) WHERE status = 'pending'
+    """)
+    cursor.execute("""
+        CREATE INDEX IF NOT EXISTS idx_reminders_chat
+        ON reminders (chat_id, status, due_at)
+    """)
+
+    # context.chat_data, shared by all webhook workers
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS chat_data (
+            chat_id INTEGER PRIMARY KEY,
+            data TEXT NOT NULL,
+            updated_at DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+    cursor.execute("SELECT 1 FROM sqlite_master WHERE name = 'user_data'")
+    if cursor.fetchone() is not None:
+        # State used to be kept per user; a private chat's id is its user's id
+        cursor.execute("""
+            INSERT OR IGNORE INTO chat_data (chat_id, data, updated_at)
+            SELECT user_id, data, updated_at FROM user_data
+        """)
+        cursor.execute("DROP TABLE user_data")
+    conn.commit()
     conn.close()
-    return rows
+
+
+async def save_interaction(user_id, category, user_message, bot_response):
+    # The index row takes the id of the interaction inserted right before it
+    await storage.write_many([
+        ("""
+            INSERT INTO interactions (user_id, category, user_message, bot_response, timestamp)
+            VALUES (?, ?, ?, ?, CURRENT_TIMESTAMP)
+        """, (user_id, category, user_message, bot_response)),
+        ("INSERT INTO interactions_fts (rowid, terms) VALUES (last_insert_rowid(), ?)",
+         (index_terms(user_id, user_message, bot_response),)),
+    ])
+
+# Serving mode: "polling" (default, for development) or "webhook" with WEBHOOK_WORKERS processes
+BOT_MODE = os.getenv("BOT_MODE", "polling")
+WEBHOOK_WORKERS = int(os.getenv("WEBHOOK_WORKERS", "1"))
+# The OPENAI_* limits are for the whole bot; each webhook worker gets an equal share
+UPSTREAM_SHARE = WEBHOOK_WORKERS if BOT_MODE == "webhook" else 1
+
+# Rate limits and backpressure for OpenAI calls
+upstream = UpstreamScheduler(
+    requests_per_minute=float(os.getenv("OPENAI_RPM", "3500")) / UPSTREAM_SHARE,
+    tokens_per_minute=float(os.getenv("OPENAI_TPM", "90000")) / UPSTREAM_SHARE,
+    max_concurrency=max(int(os.getenv("OPENAI_MAX_CONCURRENCY", "8")) // UPSTREAM_SHARE, 1),
+    max_queue=max(int(os.getenv("OPENAI_MAX_QUEUE", "100")) // UPSTREAM_SHARE, 1),
+)
+# Expected completion size, reserved from the token budget up front
+COMPLETION_TOKENS_ESTIMATE = int(os.getenv("COMPLETION_TOKENS_ESTIMATE", "500"))
+PRIORITY_PROGRAMMING = 0
+PRIORITY_CHAT = 1
+
+OPENAI_TOKENS = registry.counter(
+    "bot_openai_tokens_total", "OpenAI tokens used; estimated for streamed replies", ("kind",)
+)
+
+def record_token_usage(messages, reply, usage=None):
+    if usage:
+        prompt_tokens, completion_tokens = usage["prompt_tokens"], usage["completion_tokens"]
+    else:
+        prompt_tokens = sum(count_tokens(m["content"]) for m in messages)
+        completion_tokens = count_tokens(reply)
+    OPENAI_TOKENS.inc("prompt", amount=prompt_tokens)
+    OPENAI_TOKENS.inc("completion", amount=completion_tokens)
+
+async def summarize_history(previous_summary, turns, max_tokens):
+    history = "\n".join([f"Вопрос: {q} Ответ: {a}" for q, a in turns])
+    messages = [
+        {"role": "system", "content": "Ты кратко пересказываешь историю диалога: темы, факты о пользователе, "
+                                      "важные решения. Пиши сжато, без вступлений."},
+        {"role": "user", "content": f"Текущее резюме:\n{previous_summary or '(пусто)'}\n\n"
+                                    f"Новые сообщения:\n{history}\n\nОбнови резюме."},
+    ]
+
+    async def call():
+        response = await openai.ChatCompletion.acreate(
+            model="gpt-3.5-turbo",
+            messages=messages,
+            max_tokens=max_tokens,
+        )
+        summary = response["choices"][0]["message"]["content"]
+        record_token_usage(messages, summary, response.get("usage"))
+        return summary
+
+    tokens = sum(count_tokens(m["content"]) for m in messages) + max_tokens
+    return await upstream.submit(None, call, tokens=tokens, priority=PRIORITY_CHAT)
+
+# Full-text search over past interactions and archiving of old ones
+history_search = HistorySearch(storage)
+archive_job = ArchiveJob(storage, retention_days=int(os.getenv("HISTORY_RETENTION_DAYS", "90")))
+
+# Prompt history is limited to a token budget per category; 0 disables history
+context_builder = ContextBuilder(
+    storage,
+    summarize_history,
+    budget_tokens=int(os.getenv("CONTEXT_TOKEN_BUDGET", "2000")),
+    summary_tokens=int(os.getenv("CONTEXT_SUMMARY_TOKENS", "300")),
+    retrieve=history_search.relevant,
+    retrieval_tokens=int(os.getenv("CONTEXT_RETRIEVAL_TOKENS", "500")),
+)
+CHAT_CONTEXT_TOKEN_BUDGET = int(os.getenv("CHAT_CONTEXT_TOKEN_BUDGET", "0"))
+# Most relevant older exchanges added to programming prompts
+PROGRAMMING_RETRIEVE_K = int(os.getenv("PROGRAMMING_RETRIEVE_K", "3"))
+
+# Cache of completions; identical concurrent requests share one upstream call
+completion_cache = CompletionCache(
+    max_entries=int(os.getenv("LLM_CACHE_SIZE", "1024")),
+    ttl=float(os.getenv("LLM_CACHE_TTL", "3600")),
+    storage=storage if os.getenv("LLM_CACHE_PERSIST", "1") == "1" else None,
+    # Another user being busy is no reason to turn this one away
+    private_errors=(UserBusy,),
+)
+
+# Replies are streamed into a message that is edited as tokens arrive
+STREAM_REPLIES = os.getenv("STREAM_REPLIES", "1") == "1"
+STREAM_EDIT_INTERVAL = float(os.getenv("STREAM_EDIT_INTERVAL", "1.0"))
+
+async def stream_completion(messages, model):
+    response = await openai.ChatCompletion.acreate(
+        model=model,
+        messages=messages,
+        stream=True,
+    )
+    async for chunk in response:
+        yield chunk["choices"][0]["delta"].get("content")
+
+async def reply_with_completion(update: Update, messages, priority, model="gpt-3.5-turbo", normalize_key=True):
+    """Answer with a completion; returns None if it failed after a streamed
+    reply was started, in which case the error is shown in its place.
+
+    normalize_key lets differently cased or spaced messages share a cache
+    entry; leave it off where they can mean different things (code).
+    """
+    streamed = False
+    # Messages of the streamed reply; retries keep editing them
+    sent = []
+
+    async def call():
+        nonlocal streamed
+        if not STREAM_REPLIES:
+            response = await openai.ChatCompletion.acreate(
+                model=model,
+                messages=messages,
+            )
+            bot_reply = response["choices"][0]["message"]["content"]
+            record_token_usage(messages, bot_reply, response.get("usage"))
+            return bot_reply
+        streamed = True
+        bot_reply = await stream_reply(
+            update.message, stream_completion(messages, model), edit_interval=STREAM_EDIT_INTERVAL, sent=sent
+        )
+        record_token_usage(messages, bot_reply)
+        return bot_reply
+
+    async def notify_queued():
+        await update.message.reply_text("⏳ Сейчас много запросов, ваш вопрос в очереди.")
+
+    async def request():
+        tokens = sum(count_tokens(m["content"]) for m in messages) + COMPLETION_TOKENS_ESTIMATE
+        return await upstream.submit(
+            update.message.chat_id, call, tokens=tokens, priority=priority, on_queued=notify_queued
+        )
+
+    # Cache hits and coalesced requests get the finished text in one go
+    try:
+        bot_reply = await completion_cache.get_or_create(completion_cache.make_key(model, messages, normalize_key), request)
+    except Exception as e:
+        if not sent:
+            raise
+        await replace_reply(sent, f"Произошла ошибка: {e}")
+        return None
+    if not streamed:
+        await send_text(update.message, bot_reply)
+    return bot_reply
 
 # Menu function
 async def main_menu():
@@ -128,7 +383,10 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
     category = query.data
-    context.user_data["current_category"] = category
+    context.chat_data["current_category"] = category
+    if category != "diary":
+        # Leaving the diary: the next text is no longer a task
+        context.chat_data.pop("diary", None)
 
     if category == "programming":
         await query.edit_message_text("Категория: Программирование. Задавайте вопросы, и я постараюсь помочь!")
@@ -144,10 +402,10 @@ async def diary_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
     await query.edit_message_text("Введите задачу в формате:\n\n`Задача | 2024-12-30 15:00`", parse_mode="Markdown")
-    context.user_data['diary'] = True
+    context.chat_data['diary'] = True
 
 async def add_task(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if not context.user_data.get('diary'):
+    if not context.chat_data.get('diary'):
         return
 
     try:
@@ -155,18 +413,42 @@ async def add_task(update: Update, context: ContextTypes.DEFAULT_TYPE):
         task_datetime = datetime.strptime(task_time.strip(), "%Y-%m-%d %H:%M")
         reminder_time = task_datetime - timedelta(minutes=30)
 
-        scheduler.add_job(
-            send_reminder,
-            trigger=DateTrigger(run_date=reminder_time),
-            args=[context, update.message.chat_id, task_text.strip()],
-        )
+        await reminder_engine.add(update.message.chat_id, task_text.strip(), reminder_time.timestamp())
         await update.message.reply_text(f"Задача добавлена: {task_text.strip()}\nНапоминание в: {reminder_time.strftime('%Y-%m-%d %H:%M')}")
-        context.user_data['diary'] = False
+        context.chat_data['diary'] = False
     except Exception as e:
         await update.message.reply_text(f"Ошибка добавления задачи: {e}")
 
-async def send_reminder(context: ContextTypes.DEFAULT_TYPE, chat_id: int, task_text: str):
-    await context.bot.send_message(chat_id=chat_id, text=f"Напоминание: {task_text}")
+async def list_tasks(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    rows = await reminder_engine.list_pending(update.message.chat_id)
+    if not rows:
+        await update.message.reply_text("Активных напоминаний нет.")
+        return
+    lines = [f"#{reminder_id} {datetime.fromtimestamp(due_at).strftime('%Y-%m-%d %H:%M')} — {text}"
+             for reminder_id, text, due_at in rows]
+    await send_text(update.message, "Ваши напоминания:\n" + "\n".join(lines) + "\n\nОтменить: /cancel <номер>")
+
+async def cancel_task(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if len(context.args) != 1 or not context.args[0].lstrip("#").isdigit():
+        await update.message.reply_text("Укажите номер напоминания: /cancel 12")
+        return
+    reminder_id = int(context.args[0].lstrip("#"))
+    if await reminder_engine.cancel(update.message.chat_id, reminder_id):
+        await update.message.reply_text(f"Напоминание #{reminder_id} отменено.")
+    else:
+        await update.message.reply_text(f"Активное напоминание #{reminder_id} не найдено.")
+
+async def search_history(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = " ".join(context.args)
+    if not query:
+        await update.message.reply_text("Укажите, что искать: /search декоратор")
+        return
+    rows = await history_search.search(update.message.chat_id, query)
+    if not rows:
+        await update.message.reply_text("Ничего не найдено.")
+        return
+    lines = [f"{i}. [{category}] {question}\n{snippet}" for i, (_, category, question, snippet) in enumerate(rows, 1)]
+    await send_text(update.message, "\n\n".join(lines))
 
 # Handle text messages based on category
 async def start_button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -177,7 +459,11 @@ async def start_button_handler(update: Update, context: ContextTypes.DEFAULT_TYP
         await update.message.reply_text("Выберите категорию:", reply_markup=keyboard)
         return
 
-    current_category = context.user_data.get("current_category")
+    current_category = context.chat_data.get("current_category")
+
+    if current_category == "diary" and context.chat_data.get('diary'):
+        await add_task(update, context)
+        return
 
     if current_category == "programming":
         await handle_programming_question(update, context, user_message)
@@ -191,28 +477,21 @@ async def start_button_handler(update: Update, context: ContextTypes.DEFAULT_TYP
 
 async def handle_programming_question(update: Update, context: ContextTypes.DEFAULT_TYPE, user_message: str):
     user_id = update.message.chat_id
-    previous_queries = get_user_queries(user_id, "programming")
-
-    context_text = "\n".join([f"Вопрос: {q[0]} Ответ: {q[1]}" for q in previous_queries])
-    prompt = f"""
-    Ты помощник по программированию. Вот история предыдущих вопросов пользователя:\n{context_text}\n
-    Теперь ответь на новый вопрос:\n{user_message}
-    """
 
     try:
-        response = await openai.ChatCompletion.acreate(
-            model="gpt-3.5-turbo",
-            messages=[
-                {"role": "system", "content": "Ты — помощник по программированию."},
-                {"role": "user", "content": prompt},
-            ],
+        messages = await context_builder.build(
+            user_id, "programming", "Ты — помощник по программированию.", user_message,
+            retrieve_k=PROGRAMMING_RETRIEVE_K,
         )
-        bot_reply = response["choices"][0]["message"]["content"]
+        bot_reply = await reply_with_completion(update, messages, PRIORITY_PROGRAMMING, normalize_key=False)
 
         # Сохраняем взаимодействие
-        save_interaction(user_id, "programming", user_message, bot_reply)
-
-        await update.message.reply_text(bot_reply)
+        if bot_reply is not None:
+            await save_interaction(user_id, "programming", user_message, bot_reply)
+    except UserBusy:
+        await update.message.reply_text("Подождите, я ещё отвечаю на ваш предыдущий вопрос.")
+    except Overloaded:
+        await update.message.reply_text("Сейчас слишком много запросов, попробуйте через минуту.")
     except Exception as e:
         await update.message.reply_text(f"Произошла ошибка: {e}")
 
@@ -220,28 +499,201 @@ async def handle_database_question(update: Update, context: ContextTypes.DEFAULT
     await update.message.reply_text(f"База данных пока не подключена, но ваш вопрос: {user_message}")
 
 async def handle_chat(update: Update, context: ContextTypes.DEFAULT_TYPE, user_message: str):
+    user_id = update.message.chat_id
+
     try:
-        response = await openai.ChatCompletion.acreate(
-            model="gpt-3.5-turbo",
-            messages=[
-                {"role": "system", "content": "Ты дружелюбный собеседник. Поддерживай разговор и будь интересным."},
-                {"role": "user", "content": user_message},
-            ],
+        messages = await context_builder.build(
+            user_id, "chat", "Ты дружелюбный собеседник. Поддерживай разговор и будь интересным.", user_message,
+            budget_tokens=CHAT_CONTEXT_TOKEN_BUDGET,
         )
-        bot_reply = response["choices"][0]["message"]["content"]
-        await update.message.reply_text(bot_reply)
+        bot_reply = await reply_with_completion(update, messages, PRIORITY_CHAT)
+        if bot_reply is not None:
+            await save_interaction(user_id, "chat", user_message, bot_reply)
+    except UserBusy:
+        await update.message.reply_text("Подождите, я ещё отвечаю на ваш предыдущий вопрос.")
+    except Overloaded:
+        await update.message.reply_text("Сейчас слишком много запросов, попробуйте через минуту.")
     except Exception as e:
         await update.message.reply_text(f"Произошла ошибка: {e}")
 
+# Metrics: Prometheus endpoint (disabled unless METRICS_PORT is set) and /stats for admins
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))
+ADMIN_IDS = {int(user_id) for user_id in os.getenv("ADMIN_IDS", "").split(",") if user_id.strip()}
+
+HANDLER_SECONDS = registry.histogram("bot_handler_seconds", "Handler latency", ("handler", "category"))
+# current_category comes from callback data; anything else is labelled "other"
+METRIC_CATEGORIES = {"programming", "database", "diary", "chat"}
+registry.callback("bot_upstream_queue_depth", "Requests waiting for an OpenAI worker",
+                  lambda: upstream.stats()["queue_depth"])
+registry.callback("bot_upstream_in_flight_users", "Users with a queued or running OpenAI request",
+                  lambda: upstream.stats()["in_flight_users"])
+registry.callback("bot_upstream_rejected_total", "Requests turned away by the upstream scheduler",
+                  lambda: {"overloaded": upstream.shed, "user_busy": upstream.rejected_busy},
+                  type="counter", labelnames=("reason",))
+registry.callback("bot_upstream_retries_total", "Retried OpenAI calls", lambda: upstream.retries, type="counter")
+registry.callback("bot_completion_cache_lookups_total", "Completion cache lookups by result",
+                  lambda: {result: completion_cache.stats()[result]
+                           for result in ("hits", "persistent_hits", "misses", "coalesced")},
+                  type="counter", labelnames=("result",))
+registry.callback("bot_completion_cache_entries", "Entries in the in-memory completion cache",
+                  lambda: completion_cache.stats()["entries"])
+registry.callback("bot_storage_pending", "Operations queued for the storage thread", lambda: storage.stats()["pending"])
+registry.callback("bot_reminders_loaded", "Reminders in the in-memory window", reminder_engine.pending_count)
+
+loop_lag_monitor = LoopLagMonitor()
+
+def instrumented(name, callback):
+    async def wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE):
+        category = (context.chat_data or {}).get("current_category") or "none"
+        if category != "none" and category not in METRIC_CATEGORIES:
+            category = "other"
+        with HANDLER_SECONDS.time(name, category):
+            await callback(update, context)
+    return wrapper
+
+def _ms(seconds):
+    if seconds is None:
+        return "—"
+    if seconds == float("inf"):
+        return f">{HANDLER_SECONDS.buckets[-1]:.0f} с"
+    return f"{seconds * 1000:.0f} мс"
+
+async def stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update.effective_user.id not in ADMIN_IDS:
+        await update.message.reply_text("Команда доступна только администраторам.")
+        return
+
+    lines = ["Обработчики (кол-во, p50, p95):"]
+    for (handler, category), (_, _, count) in sorted(HANDLER_SECONDS.series()):
+        lines.append(f"  {handler}/{category}: {count}, {_ms(HANDLER_SECONDS.quantile(0.5, handler, category))}, "
+                     f"{_ms(HANDLER_SECONDS.quantile(0.95, handler, category))}")
+    lines.append("OpenAI (кол-во, p95):")
+    for (status,), (_, _, count) in sorted(OPENAI_SECONDS.series()):
+        lines.append(f"  {status}: {count}, {_ms(OPENAI_SECONDS.quantile(0.95, status))}")
+    lines.append(f"  токены: {OPENAI_TOKENS.value('prompt')} запрос, {OPENAI_TOKENS.value('completion')} ответ")
+    cache = completion_cache.stats()
+    lines.append(f"Кэш: попаданий {cache['hits'] + cache['persistent_hits']}, промахов {cache['misses']}, "
+                 f"объединено {cache['coalesced']}, доля {cache['hit_rate']:.0%}")
+    queue = upstream.stats()
+    lines.append(f"Очередь OpenAI: {queue['queue_depth']}, отклонено {queue['shed']}, повторов {queue['retries']}")
+    db = storage.stats()
+    lines.append(f"SQLite: {db['commits']} коммитов за {db['commit_seconds'] * 1000:.0f} мс, "
+                 f"{db['queries']} запросов за {db['query_seconds'] * 1000:.0f} мс, в очереди {db['pending']}")
+    lines.append(f"Напоминаний в окне: {reminder_engine.pending_count()}")
+    lines.append(f"Задержка event loop p99: {_ms(EVENT_LOOP_LAG.quantile(0.99))}")
+    await send_text(update.message, "\n".join(lines))
+
+async def start_metrics(port):
+    loop_lag_monitor.start()
+    if port:
+        return await start_metrics_server(METRICS_HOST, port)
+    return None
+
+# Bot API server; a local one can be used instead of api.telegram.org
+TELEGRAM_BASE_URL = os.getenv("TELEGRAM_BASE_URL")
+
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")
+WEBHOOK_HOST = os.getenv("WEBHOOK_HOST", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8443"))
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhook")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")
+
+async def post_init(app):
+    # Restores pending reminders from the database
+    reminder_engine.start(app.bot)
+    archive_job.start()
+
+async def post_shutdown(app):
+    await archive_job.stop()
+    await reminder_engine.stop()
+
+def build_application():
+    # Chats are handled concurrently, each chat's updates in order; upstream limits the OpenAI side
+    builder = (
+        ApplicationBuilder()
+        .token(TELEGRAM_TOKEN)
+        .concurrent_updates(PerChatUpdateProcessor(256))
+        .persistence(SQLitePersistence(storage))
+        .post_init(post_init)
+        .post_shutdown(post_shutdown)
+    )
+    if TELEGRAM_BASE_URL:
+        builder = builder.base_url(f"{TELEGRAM_BASE_URL}/bot")
+    app = builder.build()
+    app.add_handler(CommandHandler("start", instrumented("start", animated_start_menu)))
+    app.add_handler(CommandHandler("tasks", instrumented("tasks", list_tasks)))
+    app.add_handler(CommandHandler("cancel", instrumented("cancel", cancel_task)))
+    app.add_handler(CommandHandler("search", instrumented("search", search_history)))
+    app.add_handler(CommandHandler("stats", instrumented("stats", stats_command)))
+    app.add_handler(CallbackQueryHandler(instrumented("button_handler", button_handler)))
+    app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, instrumented("message", start_button_handler)))
+    return app
+
+async def close_services(metrics_server=None):
+    if metrics_server is not None:
+        metrics_server.close()
+    await loop_lag_monitor.stop()
+    # Background summarization goes through upstream
+    await context_builder.stop()
+    await upstream.stop()
+    logging.info(f"Статистика кэша ответов: {completion_cache.stats()}")
+    # Commit whatever is still queued
+    storage.close()
+
+async def webhook_worker(index, updates):
+    storage.start()
+    # Each worker exposes its own metrics on METRICS_PORT + index
+    metrics_server = await start_metrics(METRICS_PORT + index if METRICS_PORT else 0)
+    app = build_application()
+    await app.initialize()
+    # One process delivers reminders (otherwise they would be sent N times) and archives history
+    if index == 0:
+        if WEBHOOK_WORKERS > 1:
+            reminder_engine.poll_interval = REMINDER_POLL_INTERVAL
+        await post_init(app)
+    await app.start()
+    try:
+        async for data in iter_updates(updates):
+            await app.update_queue.put(Update.de_json(json.loads(data), app.bot))
+    finally:
+        await app.stop()
+        if index == 0:
+            await post_shutdown(app)
+        await app.shutdown()
+        await close_services(metrics_server)
+
+def run_webhook_worker(index, updates):
+    asyncio.run(webhook_worker(index, updates))
+
+async def run_webhook():
+    initialize_db()
+    async with Bot(TELEGRAM_TOKEN) as bot:
+        await bot.set_webhook(url=WEBHOOK_URL, secret_token=WEBHOOK_SECRET, allowed_updates=Update.ALL_TYPES)
+    dispatcher = WebhookDispatcher(
+        run_webhook_worker,
+        workers=WEBHOOK_WORKERS,
+        host=WEBHOOK_HOST,
+        port=WEBHOOK_PORT,
+        path=WEBHOOK_PATH,
+        secret_token=WEBHOOK_SECRET,
+    )
+    await dispatcher.serve_forever()
+
 # Main function
 async def main():
+    if BOT_MODE == "webhook":
+        await run_webhook()
+        return
+
     initialize_db()
-    scheduler.start()
-    app = ApplicationBuilder().token(TELEGRAM_TOKEN).build()
-    app.add_handler(CommandHandler("start", animated_start_menu))
-    app.add_handler(CallbackQueryHandler(button_handler))
-    app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, start_button_handler))
-    await app.run_polling()
+    storage.start()
+    metrics_server = await start_metrics(METRICS_PORT)
+    app = build_application()
+    try:
+        await app.run_polling()
+    finally:
+        await close_services(metrics_server)
 
 if __name__ == "__main__":
-    asyncio.run(main())
\ No newline at end of file
+    asyncio.run(main())
@@ -0,0 +1,77 @@
+import json
+
+from telegram.ext import BasePersistence, PersistenceInput
+
+
+class SQLitePersistence(BasePersistence):
+    """Keeps context.chat_data in the chat_data table.
+
+    Only chat_data is stored; the table is shared by all webhook workers
+    and survives restarts. Webhook updates are sharded by chat_id, so a
+    chat's updates always reach the same worker: its in-memory copy is
+    authoritative and refresh_chat_data is a no-op.
+    """
+
+    def __init__(self, storage, update_interval: float = 1):
+        super().__init__(
+            store_data=PersistenceInput(bot_data=False, chat_data=True, user_data=False, callback_data=False),
+            update_interval=update_interval,
+        )
+        self.storage = storage
+
+    async def get_chat_data(self):
+        rows = await self.storage.fetchall("SELECT chat_id, data FROM chat_data")
+        return {chat_id: json.loads(data) for chat_id, data in rows}
+
+    async def update_chat_data(self, chat_id, data):
+        await self.storage.write("""
+            INSERT INTO chat_data (chat_id, data)
+            VALUES (?, ?)
+            ON CONFLICT (chat_id) DO UPDATE SET
+                data = excluded.data,
+                updated_at = CURRENT_TIMESTAMP
+        """, (chat_id, json.dumps(data, ensure_ascii=False)))
+
+    async def drop_chat_data(self, chat_id):
+        await self.storage.write("DELETE FROM chat_data WHERE chat_id = ?", (chat_id,))
+
+    async def refresh_chat_data(self, chat_id, chat_data):
+        pass
+
+    async def flush(self):
+        await self.storage.flush()
+
+    # Not stored
+
+    async def get_user_data(self):
+        return {}
+
+    async def get_bot_data(self):
+        return {}
+
+    async def get_callback_data(self):
+        return None
+
+    async def get_conversations(self, name):
+        return {}
+
+    async def update_conversation(self, name, key, new_state):
+        pass
+
+    async def update_user_data(self, user_id, data):
+        pass
+
+    async def update_bot_data(self, data):
+        pass
+
+    async def update_callback_data(self, data):
+        pass
+
+    async def drop_user_data(self, user_id):
+        pass
+
+    async def refresh_user_data(self, user_id, user_data):
+        pass
+
+    async def refresh_bot_data(self, bot_data):
+        pass
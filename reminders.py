@@ -0,0 +1,258 @@
+import asyncio
+import heapq
+import logging
+import time
+
+from telegram.error import BadRequest, Forbidden, RetryAfter
+
+# Retrying won't help: the bot was blocked, the chat is gone, etc.
+PERMANENT_ERRORS = (Forbidden, BadRequest)
+
+
+def _claim(conn, ids):
+    # Only a still pending reminder is sent: it may have been cancelled or
+    # claimed since it was loaded
+    claimed = []
+    conn.execute("BEGIN")
+    try:
+        for reminder_id in ids:
+            cursor = conn.execute("""
+                UPDATE reminders SET status = 'sending'
+                WHERE id = ? AND status = 'pending'
+            """, (reminder_id,))
+            if cursor.rowcount == 1:
+                claimed.append(reminder_id)
+        conn.execute("COMMIT")
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+    return claimed
+
+
+class ReminderEngine:
+    """Delivers reminders stored in the reminders table.
+
+    Only reminders due within the next `window` seconds are kept in memory,
+    in a heap served by a single timer loop; the window is reloaded from the
+    (status, due_at) index as it runs out, so pending reminders survive
+    restarts without one scheduler job per reminder. Transient send errors
+    are retried with exponential backoff up to max_attempts times.
+
+    Each reminder is claimed in the database right before it is sent, so
+    one cancelled elsewhere is never delivered. When other processes add
+    reminders (webhook workers), set poll_interval to pick up their new
+    rows between window reloads.
+    """
+
+    def __init__(self, storage, window: float = 3600, max_loaded: int = 5000, send_rate: int = 25,
+                 max_attempts: int = 5, retry_delay: float = 5.0, poll_interval: float = None):
+        self.storage = storage
+        self.window = window
+        self.max_loaded = max_loaded
+        self.send_rate = send_rate
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self.poll_interval = poll_interval
+        self._heap = []
+        self._cancelled = set()
+        self._attempts = {}
+        self._window_end = 0.0
+        self._max_id = 0
+        self._next_poll = float("inf")
+        self._wakeup = asyncio.Event()
+        self._task = None
+        self._bot = None
+
+    def start(self, bot):
+        self._bot = bot
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+
+    def pending_count(self) -> int:
+        return len(self._heap)
+
+    async def add(self, chat_id: int, text: str, due_at: float) -> int:
+        reminder_id, _ = await self.storage.execute("""
+            INSERT INTO reminders (chat_id, text, due_at)
+            VALUES (?, ?, ?)
+        """, (chat_id, text, due_at))
+        if due_at < self._window_end:
+            heapq.heappush(self._heap, (due_at, reminder_id, chat_id, text))
+            self._wakeup.set()
+        return reminder_id
+
+    async def list_pending(self, chat_id: int):
+        return await self.storage.fetchall("""
+            SELECT id, text, due_at FROM reminders
+            WHERE chat_id = ? AND status = 'pending'
+            ORDER BY due_at
+        """, (chat_id,))
+
+    async def cancel(self, chat_id: int, reminder_id: int) -> bool:
+        _, rowcount = await self.storage.execute("""
+            UPDATE reminders SET status = 'cancelled'
+            WHERE id = ? AND chat_id = ? AND status = 'pending'
+        """, (reminder_id, chat_id))
+        if rowcount:
+            # Removed from the heap lazily when it comes up
+            self._cancelled.add(reminder_id)
+        return bool(rowcount)
+
+    async def _load_window(self):
+        now = time.time()
+        window_end = now + self.window
+        # Rows added from now on are found by _poll_new
+        (self._max_id,), = await self.storage.fetchall("SELECT COALESCE(MAX(id), 0) FROM reminders")
+        rows = await self.storage.fetchall("""
+            SELECT due_at, id, chat_id, text FROM reminders
+            WHERE status = 'pending' AND due_at < ?
+            ORDER BY due_at
+            LIMIT ?
+        """, (window_end, self.max_loaded))
+        if len(rows) == self.max_loaded:
+            # Too many in the window: reload once the last loaded one is due
+            window_end = rows[-1][0]
+        self._heap = rows
+        heapq.heapify(self._heap)
+        self._cancelled.clear()
+        self._window_end = window_end
+        if self.poll_interval:
+            self._next_poll = now + self.poll_interval
+        logging.info(f"Загружено напоминаний: {len(rows)}")
+
+    async def _poll_new(self):
+        rows = await self.storage.fetchall("""
+            SELECT due_at, id, chat_id, text, status FROM reminders
+            WHERE id > ?
+            ORDER BY id
+        """, (self._max_id,))
+        for due_at, reminder_id, chat_id, text, status in rows:
+            # Already in the heap if added here; _claim drops the duplicate
+            if status == "pending" and due_at < self._window_end:
+                heapq.heappush(self._heap, (due_at, reminder_id, chat_id, text))
+        if rows:
+            self._max_id = rows[-1][1]
+        self._next_poll = time.time() + self.poll_interval
+
+    async def _run(self):
+        # Reminders a crash left half-sent are sent again
+        await self.storage.write("UPDATE reminders SET status = 'pending' WHERE status = 'sending'")
+        while True:
+            try:
+                if time.time() >= self._window_end:
+                    await self._load_window()
+                elif time.time() >= self._next_poll:
+                    await self._poll_new()
+                now = time.time()
+                due = []
+                while self._heap and self._heap[0][0] <= now:
+                    item = heapq.heappop(self._heap)
+                    if item[1] in self._cancelled:
+                        self._cancelled.discard(item[1])
+                        continue
+                    due.append(item)
+                if due:
+                    await self._deliver(due)
+                    continue
+
+                next_at = min(self._window_end, self._next_poll)
+                if self._heap:
+                    next_at = min(next_at, self._heap[0][0])
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=max(next_at - now, 0))
+                except asyncio.TimeoutError:
+                    pass
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logging.error(f"Ошибка в цикле напоминаний: {e}")
+                await asyncio.sleep(5)
+
+    async def _deliver(self, due):
+        # Telegram allows about 30 messages per second across all chats
+        for start in range(0, len(due), self.send_rate):
+            batch = due[start:start + self.send_rate]
+            batch_started = time.monotonic()
+            by_id = {item[1]: item for item in batch}
+            try:
+                claimed = await self.storage.run(lambda conn: _claim(conn, list(by_id)))
+            except Exception:
+                # Still pending in the database: keep them for the next pass
+                for item in due[start:]:
+                    heapq.heappush(self._heap, item)
+                raise
+            batch = [by_id[reminder_id] for reminder_id in claimed]
+            results = await asyncio.gather(
+                *(self._bot.send_message(chat_id=chat_id, text=f"Напоминание: {text}") for _, _, chat_id, text in batch),
+                return_exceptions=True,
+            )
+
+            sent, failed, released = [], [], []
+            retry_after = 0
+            for item, result in zip(batch, results):
+                if isinstance(result, RetryAfter):
+                    heapq.heappush(self._heap, item)
+                    released.append(item[1])
+                    retry_after = max(retry_after, result.retry_after)
+                elif isinstance(result, Exception):
+                    self._retry_or_fail(item, result, failed, released)
+                else:
+                    self._attempts.pop(item[1], None)
+                    sent.append(item[1])
+            await self._set_status(sent, "sent")
+            await self._set_status(failed, "failed")
+            await self._release(released)
+
+            if retry_after:
+                # Flood control is per bot: pause delivery, the rest stays queued
+                for item in due[start + self.send_rate:]:
+                    heapq.heappush(self._heap, item)
+                await asyncio.sleep(retry_after)
+                return
+
+            elapsed = time.monotonic() - batch_started
+            if start + self.send_rate < len(due) and elapsed < 1:
+                await asyncio.sleep(1 - elapsed)
+
+    def _retry_or_fail(self, item, error, failed, released):
+        _, reminder_id, chat_id, text = item
+        attempts = self._attempts.get(reminder_id, 0) + 1
+        if isinstance(error, PERMANENT_ERRORS) or attempts >= self.max_attempts:
+            logging.error(f"Не удалось отправить напоминание {reminder_id}: {error}")
+            self._attempts.pop(reminder_id, None)
+            failed.append(reminder_id)
+            return
+        self._attempts[reminder_id] = attempts
+        delay = self.retry_delay * 2 ** (attempts - 1)
+        logging.warning(f"Напоминание {reminder_id} не отправлено ({error}), повтор через {delay:.0f} с")
+        heapq.heappush(self._heap, (time.time() + delay, reminder_id, chat_id, text))
+        released.append(reminder_id)
+
+    async def _set_status(self, ids, status):
+        if not ids:
+            return
+        placeholders = ", ".join("?" * len(ids))
+        await self.storage.write(
+            f"UPDATE reminders SET status = ?, sent_at = CURRENT_TIMESTAMP WHERE id IN ({placeholders})",
+            (status, *ids),
+        )
+
+    async def _release(self, ids):
+        # Back to pending until the retry, so it can still be cancelled
+        if not ids:
+            return
+        placeholders = ", ".join("?" * len(ids))
+        await self.storage.write(
+            f"UPDATE reminders SET status = 'pending' WHERE id IN ({placeholders}) AND status = 'sending'",
+            tuple(ids),
+        )
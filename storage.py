@@ -0,0 +1,213 @@
+import asyncio
+import logging
+import queue
+import sqlite3
+import threading
+import time
+
+from metrics import registry
+
+# Kinds of queued operations
+_WRITE = "write"
+_WRITE_MANY = "write_many"
+_READ = "read"
+_EXECUTE = "execute"
+_RUN = "run"
+_FLUSH = "flush"
+_CLOSE = object()
+
+SQLITE_SECONDS = registry.histogram(
+    "bot_sqlite_seconds", "Time spent in SQLite on the storage thread", ("op",),
+    buckets=(0.0001, 0.0005, 0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1),
+)
+
+
+class Storage:
+    """One long-lived SQLite connection owned by a dedicated thread.
+
+    Writes are queued and committed in batches (write-behind); reads are
+    executed on the same thread and their results are handed back to the
+    event loop, so the loop never waits on SQLite or fsync.
+    """
+
+    def __init__(self, path: str, batch_size: int = 200, flush_interval: float = 0.05, max_pending: int = 10000):
+        self.path = path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._queue = queue.Queue(maxsize=max_pending)
+        self._thread = None
+        self._conn = None
+        self._start_error = None
+        # Time spent inside SQLite on the storage thread
+        self.commits = 0
+        self.commit_seconds = 0.0
+        self.queries = 0
+        self.query_seconds = 0.0
+
+    def start(self):
+        if self._thread is not None:
+            return
+        ready = threading.Event()
+        self._thread = threading.Thread(target=self._run, args=(ready,), name="storage", daemon=True)
+        self._thread.start()
+        ready.wait()
+        if self._start_error is not None:
+            error, self._start_error = self._start_error, None
+            self._thread.join()
+            self._thread = None
+            raise error
+
+    def close(self):
+        if self._thread is None:
+            return
+        self._queue.put(_CLOSE)
+        self._thread.join()
+        self._thread = None
+
+    async def _put(self, item):
+        try:
+            self._queue.put_nowait(item)
+        except queue.Full:
+            # Backpressure: wait for room off the event loop
+            await asyncio.to_thread(self._queue.put, item)
+
+    async def _call(self, kind, sql=None, params=()):
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        await self._put((kind, sql, params, future, loop))
+        return await future
+
+    async def write(self, sql: str, params=()):
+        await self._put((_WRITE, sql, params, None, None))
+
+    async def write_many(self, statements):
+        """Queue (sql, params) pairs that run back to back in one transaction."""
+        await self._put((_WRITE_MANY, None, list(statements), None, None))
+
+    async def fetchall(self, sql: str, params=()):
+        return await self._call(_READ, sql, params)
+
+    async def execute(self, sql: str, params=()):
+        """Run a statement right away; returns (lastrowid, rowcount)."""
+        return await self._call(_EXECUTE, sql, params)
+
+    async def run(self, fn):
+        """Call fn(connection) on the storage thread, e.g. for a multi-statement transaction."""
+        return await self._call(_RUN, fn)
+
+    async def flush(self):
+        await self._call(_FLUSH)
+
+    def stats(self) -> dict:
+        return {
+            "pending": self._queue.qsize(),
+            "commits": self.commits,
+            "commit_seconds": self.commit_seconds,
+            "queries": self.queries,
+            "query_seconds": self.query_seconds,
+        }
+
+    # --- storage thread ---
+
+    def _connect(self):
+        # The statement cache keeps our constant SQL strings prepared
+        conn = sqlite3.connect(self.path, isolation_level=None, check_same_thread=False, cached_statements=256)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("PRAGMA busy_timeout=5000")
+        return conn
+
+    def _run(self, ready: threading.Event):
+        try:
+            self._conn = self._connect()
+        except Exception as e:
+            # Handed to start(), which would otherwise wait forever
+            self._start_error = e
+            ready.set()
+            return
+        ready.set()
+        pending = []
+        deadline = None
+        while True:
+            timeout = None if deadline is None else max(deadline - time.monotonic(), 0)
+            try:
+                item = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                self._commit(pending)
+                pending, deadline = [], None
+                continue
+
+            if item is _CLOSE:
+                self._commit(pending)
+                self._conn.close()
+                return
+
+            kind, sql, params, future, loop = item
+            if kind == _WRITE or kind == _WRITE_MANY:
+                if kind == _WRITE:
+                    pending.append((sql, params))
+                else:
+                    pending.extend(params)
+                if deadline is None:
+                    deadline = time.monotonic() + self.flush_interval
+                if len(pending) >= self.batch_size:
+                    self._commit(pending)
+                    pending, deadline = [], None
+                continue
+
+            # Reads see every write queued before them
+            self._commit(pending)
+            pending, deadline = [], None
+            started = time.perf_counter()
+            try:
+                result = self._execute(kind, sql, params)
+            except Exception as e:
+                loop.call_soon_threadsafe(_resolve, future, None, e)
+            else:
+                loop.call_soon_threadsafe(_resolve, future, result, None)
+            elapsed = time.perf_counter() - started
+            self.queries += 1
+            self.query_seconds += elapsed
+            SQLITE_SECONDS.observe(elapsed, kind)
+
+    def _execute(self, kind, sql, params):
+        if kind == _READ:
+            return self._conn.execute(sql, params).fetchall()
+        if kind == _EXECUTE:
+            cursor = self._conn.execute(sql, params)
+            return cursor.lastrowid, cursor.rowcount
+        if kind == _RUN:
+            # The callable travels in the sql slot
+            return sql(self._conn)
+        return None
+
+    def _commit(self, pending):
+        if not pending:
+            return
+        started = time.perf_counter()
+        try:
+            self._conn.execute("BEGIN")
+            for sql, params in pending:
+                self._conn.execute(sql, params)
+            self._conn.execute("COMMIT")
+        except Exception as e:
+            self._conn.execute("ROLLBACK")
+            logging.error(f"Ошибка пакетной записи в БД, повтор по одной: {e}")
+            for sql, params in pending:
+                try:
+                    self._conn.execute(sql, params)
+                except Exception as e:
+                    logging.error(f"Ошибка записи в БД: {e}")
+        elapsed = time.perf_counter() - started
+        self.commits += 1
+        self.commit_seconds += elapsed
+        SQLITE_SECONDS.observe(elapsed, "commit")
+
+
+def _resolve(future, result, error):
+    if future.cancelled():
+        return
+    if error is not None:
+        future.set_exception(error)
+    else:
+        future.set_result(result)
@@ -0,0 +1,112 @@
+import asyncio
+import logging
+import time
+
+from telegram.error import BadRequest, RetryAfter, TelegramError
+
+TELEGRAM_MAX_MESSAGE_LENGTH = 4096
+CURSOR = " ▌"
+
+
+def split_text(text: str, limit: int = TELEGRAM_MAX_MESSAGE_LENGTH):
+    # Prefer breaking on a newline, then on a space, in the second half of the chunk
+    parts = []
+    while len(text) > limit:
+        cut = text.rfind("\n", limit // 2, limit)
+        if cut == -1:
+            cut = text.rfind(" ", limit // 2, limit)
+        if cut == -1:
+            cut = limit
+        parts.append(text[:cut])
+        text = text[cut:].lstrip("\n")
+    parts.append(text)
+    return parts
+
+
+async def send_text(message, text: str):
+    for part in split_text(text):
+        await message.reply_text(part)
+
+
+async def stream_reply(message, chunks, edit_interval: float = 1.0, placeholder: str = "…", sent=None):
+    """Send a placeholder right away and keep editing it as chunks arrive.
+
+    Edits are throttled to one per edit_interval; text that outgrows a
+    single Telegram message continues in new messages. The messages are
+    collected in sent; passing the list of a failed attempt (on retries)
+    reuses them and deletes the ones the new text doesn't need. Returns
+    the full text.
+    """
+    started = time.monotonic()
+    if sent is None:
+        sent = []
+    if not sent:
+        sent.append(await message.reply_text(placeholder))
+    # Messages left from an earlier attempt are always re-rendered
+    shown = [None] * len(sent)
+    text = ""
+    first_token_at = None
+    next_edit = 0.0
+
+    async def render(final: bool):
+        nonlocal next_edit
+        parts = split_text(text)
+        for i, part in enumerate(parts):
+            is_last = i == len(parts) - 1
+            content = part
+            # The cursor is left out when it would push a full part over the limit
+            if not final and is_last and len(part) + len(CURSOR) <= TELEGRAM_MAX_MESSAGE_LENGTH:
+                content += CURSOR
+            if i == len(sent):
+                sent.append(await message.reply_text(content))
+                shown.append(content)
+                continue
+            if shown[i] == content:
+                continue
+            try:
+                await sent[i].edit_text(content)
+                shown[i] = content
+            except RetryAfter as e:
+                if final:
+                    await asyncio.sleep(e.retry_after)
+                    await sent[i].edit_text(content)
+                    shown[i] = content
+                else:
+                    next_edit = time.monotonic() + e.retry_after
+                    return
+            except BadRequest as e:
+                if "not modified" not in str(e).lower():
+                    raise
+        next_edit = time.monotonic() + edit_interval
+
+    async for chunk in chunks:
+        if not chunk:
+            continue
+        if first_token_at is None:
+            first_token_at = time.monotonic()
+            logging.info(f"Время до первого токена: {first_token_at - started:.2f} с")
+        text += chunk
+        if time.monotonic() >= next_edit:
+            await render(final=False)
+
+    if not text:
+        text = placeholder
+    await render(final=True)
+    await _delete_extra(sent, len(split_text(text)))
+    logging.info(f"Ответ отправлен потоком за {time.monotonic() - started:.2f} с, {len(sent)} сообщ.")
+    return text
+
+
+async def replace_reply(sent, text: str):
+    """Show text in place of a partly streamed reply, dropping its other messages."""
+    await _delete_extra(sent, 1)
+    await sent[0].edit_text(text[:TELEGRAM_MAX_MESSAGE_LENGTH])
+
+
+async def _delete_extra(sent, keep: int):
+    for extra in sent[keep:]:
+        try:
+            await extra.delete()
+        except TelegramError as e:
+            logging.error(f"Не удалось удалить сообщение {extra.message_id}: {e}")
+    del sent[keep:]
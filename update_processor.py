@@ -0,0 +1,69 @@
+import asyncio
+import logging
+from collections import deque
+
+from telegram import Update
+from telegram.ext import BaseUpdateProcessor
+
+
+def _chat_key(update):
+    if not isinstance(update, Update):
+        return None
+    if update.effective_chat is not None:
+        return update.effective_chat.id
+    if update.effective_user is not None:
+        return update.effective_user.id
+    return None
+
+
+class PerChatUpdateProcessor(BaseUpdateProcessor):
+    """Handles the updates of one chat one after another, in arrival order,
+    and the updates of different chats concurrently.
+
+    Each chat with pending updates gets its own queue drained by one task;
+    max_concurrent_updates bounds how many handlers run at once. A chat
+    that sends many updates only waits behind itself.
+    """
+
+    def __init__(self, max_concurrent_updates: int = 256):
+        super().__init__(max_concurrent_updates)
+        self._running = asyncio.Semaphore(max_concurrent_updates)
+        self._queues = {}
+        self._tasks = set()
+
+    async def do_process_update(self, update, coroutine):
+        key = _chat_key(update)
+        if key is None:
+            await coroutine
+            return
+        queue = self._queues.get(key)
+        if queue is not None:
+            queue.append(coroutine)
+            return
+        self._queues[key] = deque([coroutine])
+        task = asyncio.create_task(self._drain(key))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _drain(self, key):
+        queue = self._queues[key]
+        try:
+            while queue:
+                coroutine = queue.popleft()
+                async with self._running:
+                    try:
+                        await coroutine
+                    except Exception as e:
+                        logging.error(f"Ошибка обработки обновления чата {key}: {e}")
+        finally:
+            del self._queues[key]
+            # Never started if the task was cancelled
+            for coroutine in queue:
+                coroutine.close()
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        # Let queued updates finish before persistence is flushed
+        await asyncio.gather(*self._tasks, return_exceptions=True)
@@ -0,0 +1,164 @@
+import asyncio
+import itertools
+import logging
+import random
+import time
+
+from metrics import registry
+
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+OPENAI_SECONDS = registry.histogram("bot_openai_request_seconds", "OpenAI call duration per attempt", ("status",))
+OPENAI_ERRORS = registry.counter("bot_openai_errors_total", "Failed OpenAI call attempts", ("status",))
+
+
+class UserBusy(Exception):
+    pass
+
+
+class Overloaded(Exception):
+    pass
+
+
+class TokenBucket:
+    def __init__(self, rate_per_minute: float):
+        self.capacity = rate_per_minute
+        self.rate = rate_per_minute / 60
+        self.tokens = rate_per_minute
+        self.updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self, amount: float = 1):
+        amount = min(amount, self.capacity)
+        # The lock keeps waiters in FIFO order
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= amount:
+                    self.tokens -= amount
+                    return
+                await asyncio.sleep((amount - self.tokens) / self.rate)
+
+
+def _status(error):
+    return getattr(error, "http_status", None) or getattr(error, "status_code", None)
+
+
+class UpstreamScheduler:
+    """Admission control in front of the OpenAI client.
+
+    At most one request per user is queued or running; the shared queue is
+    bounded and ordered by priority; workers take requests only when the
+    request and token buckets allow it and retry 429/5xx with jittered
+    exponential backoff.
+    """
+
+    def __init__(self, requests_per_minute: float = 3500, tokens_per_minute: float = 90000, max_concurrency: int = 8,
+                 max_queue: int = 100, max_retries: int = 4, base_delay: float = 1.0, max_delay: float = 30.0):
+        self.requests = TokenBucket(requests_per_minute)
+        self.tokens = TokenBucket(tokens_per_minute)
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self._queue = None
+        self._workers = []
+        self._idle = 0
+        self._users = set()
+        self._seq = itertools.count()
+        self.shed = 0
+        self.rejected_busy = 0
+        self.retries = 0
+
+    def _ensure_started(self):
+        if self._workers:
+            return
+        self._queue = asyncio.PriorityQueue(maxsize=self.max_queue)
+        self._workers = [asyncio.create_task(self._worker()) for _ in range(self.max_concurrency)]
+
+    async def stop(self):
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+
+    async def submit(self, user_id, call, tokens: int = 0, priority: int = 1, on_queued=None):
+        self._ensure_started()
+        # user_id None is for internal calls that aren't tied to a user
+        if user_id is not None and user_id in self._users:
+            self.rejected_busy += 1
+            raise UserBusy()
+
+        future = asyncio.get_running_loop().create_future()
+        try:
+            self._queue.put_nowait((priority, next(self._seq), call, tokens, future))
+        except asyncio.QueueFull:
+            self.shed += 1
+            raise Overloaded()
+
+        if user_id is not None:
+            self._users.add(user_id)
+        try:
+            if self._idle < self._queue.qsize() and on_queued is not None:
+                await on_queued()
+            return await future
+        finally:
+            self._users.discard(user_id)
+
+    def stats(self) -> dict:
+        return {
+            "queue_depth": self._queue.qsize() if self._queue else 0,
+            "in_flight_users": len(self._users),
+            "shed": self.shed,
+            "rejected_busy": self.rejected_busy,
+            "retries": self.retries,
+        }
+
+    async def _worker(self):
+        while True:
+            self._idle += 1
+            try:
+                _, _, call, tokens, future = await self._queue.get()
+            finally:
+                self._idle -= 1
+            if future.cancelled():
+                continue
+            try:
+                result = await self._call_with_retry(call, tokens)
+            except asyncio.CancelledError:
+                future.cancel()
+                raise
+            except Exception as e:
+                if not future.done():
+                    future.set_exception(e)
+            else:
+                if not future.done():
+                    future.set_result(result)
+
+    async def _call_with_retry(self, call, tokens):
+        attempt = 0
+        while True:
+            await self.requests.acquire()
+            await self.tokens.acquire(tokens)
+            started = time.perf_counter()
+            try:
+                result = await call()
+            except Exception as e:
+                status = _status(e)
+                label = str(status or type(e).__name__)
+                OPENAI_SECONDS.observe(time.perf_counter() - started, label)
+                OPENAI_ERRORS.inc(label)
+                if status not in RETRY_STATUSES or attempt >= self.max_retries:
+                    raise
+                # Full jitter keeps retries from synchronizing across workers
+                delay = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+                attempt += 1
+                self.retries += 1
+                logging.warning(f"OpenAI ответил {status}, повтор {attempt} через {delay:.1f} с")
+                await asyncio.sleep(delay)
+            else:
+                OPENAI_SECONDS.observe(time.perf_counter() - started, "ok")
+                return result
@@ -0,0 +1,113 @@
+import asyncio
+import hmac
+import json
+import logging
+import multiprocessing
+
+from httpserver import serve_connection, write_response
+
+# Update kinds whose chat is at update[kind]["chat"]
+_CHAT_KINDS = ("message", "edited_message", "channel_post", "edited_channel_post",
+               "my_chat_member", "chat_member", "chat_join_request")
+
+
+def chat_id_of(update: dict):
+    for kind in _CHAT_KINDS:
+        if kind in update:
+            return update[kind]["chat"]["id"]
+    callback_query = update.get("callback_query")
+    if callback_query is not None:
+        message = callback_query.get("message")
+        return message["chat"]["id"] if message else callback_query["from"]["id"]
+    # Inline queries, polls etc.: fall back to the sender
+    for value in update.values():
+        if isinstance(value, dict) and "from" in value:
+            return value["from"]["id"]
+    return None
+
+
+async def iter_updates(updates):
+    """Yield raw updates a worker receives from the dispatcher until it stops."""
+    while True:
+        data = await asyncio.to_thread(updates.get)
+        if data is None:
+            return
+        yield data
+
+
+class WebhookDispatcher:
+    """Embedded HTTP server for Telegram webhooks.
+
+    Each update is handed to one of `workers` processes, chosen by chat_id,
+    so a chat is always served by the same process and in arrival order.
+    worker_target(index, updates, *worker_args) runs in each process and
+    reads raw update bodies with iter_updates(updates).
+    """
+
+    def __init__(self, worker_target, workers: int = 1, host: str = "0.0.0.0", port: int = 8443,
+                 path: str = "/webhook", secret_token: str = None, worker_args=(), max_body: int = 1 << 20):
+        self.worker_target = worker_target
+        self.workers = workers
+        self.host = host
+        self.port = port
+        self.path = path
+        self.secret_token = secret_token
+        self.worker_args = worker_args
+        self.max_body = max_body
+        self._queues = []
+        self._processes = []
+        self._server = None
+        self.received = 0
+
+    async def start(self):
+        ctx = multiprocessing.get_context("spawn")
+        for index in range(self.workers):
+            updates = ctx.Queue()
+            process = ctx.Process(
+                target=self.worker_target, args=(index, updates, *self.worker_args), name=f"bot-worker-{index}"
+            )
+            process.start()
+            self._queues.append(updates)
+            self._processes.append(process)
+        self._server = await asyncio.start_server(
+            lambda reader, writer: serve_connection(reader, writer, self._handle, self.max_body), self.host, self.port
+        )
+        self.port = self._server.sockets[0].getsockname()[1]
+        logging.info(f"Webhook слушает {self.host}:{self.port}{self.path}, процессов: {self.workers}")
+
+    async def stop(self):
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+        for updates in self._queues:
+            updates.put(None)
+        for process in self._processes:
+            await asyncio.to_thread(process.join)
+        self._queues, self._processes = [], []
+
+    async def serve_forever(self):
+        await self.start()
+        try:
+            await asyncio.Event().wait()
+        finally:
+            await self.stop()
+
+    def _dispatch(self, request):
+        if request.method != "POST" or request.path != self.path:
+            return 404
+        if self.secret_token is not None:
+            token = request.headers.get("x-telegram-bot-api-secret-token", "")
+            if not hmac.compare_digest(token, self.secret_token):
+                return 403
+        try:
+            chat_id = chat_id_of(json.loads(request.body))
+        except (ValueError, KeyError, TypeError, AttributeError):
+            return 400
+        shard = chat_id % self.workers if chat_id is not None else 0
+        self._queues[shard].put(request.body)
+        self.received += 1
+        return 200
+
+    async def _handle(self, request, writer):
+        await write_response(writer, self._dispatch(request), keep_alive=request.keep_alive)